@@ -0,0 +1,124 @@
+# MRWF - extra/eventimages.py
+#
+# Copyright (C) 2009, 2010, 2011. 2012, 2013
+# Guillaume Tucker <guillaume@mangoz.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Processing of the uploaded event images, run as tasks by export_worker.
+
+import logging
+from django.core.files.storage import default_storage
+from django.db.models.signals import pre_delete, post_delete
+from mrwf.settings import IMG_MAX_D, IMG_MAX_d
+from mrwf.extra.models import (FairEvent, StallEvent, FairEventImageSize,
+                               IMG_STORE_DIR)
+from mrwf.extra import imaging, jobs
+
+JOB_NAME = 'event_image'
+
+
+def prepare(event):
+    """Set up a new event image before the event is saved.
+
+    If the same image has already been processed, the event gets the stored
+    file and is ready.  Otherwise the image needs to be processed.
+    """
+    digest = imaging.file_digest(event.image)
+    if event.image._committed:
+        event.image.close()
+    event.image_source_hash = digest
+    same = FairEvent.objects.filter(image_source_hash=digest, image_ready=True)
+    for other in same.exclude(image='')[:1]:
+        # the uploaded file, if not saved yet, is discarded
+        event.image = other.image.name
+        event.image_width = other.image_width
+        event.image_height = other.image_height
+        event.image_size = other.image_size
+        event.image_hash = other.image_hash
+        event.image_ready = True
+        return
+    event.set_image_info(None)
+    event.image_ready = False
+
+
+def release(names):
+    """Delete the image files which are not used by any event."""
+    for name in set(names):
+        if not name:
+            continue
+        if FairEvent.objects.filter(image=name).exists():
+            continue
+        if FairEventImageSize.objects.filter(name=name).exists():
+            continue
+        default_storage.delete(name)
+
+
+def submit(event):
+    params = {'event_id': event.pk, 'name': event.image.name}
+    return jobs.submit_task(JOB_NAME, params)
+
+
+def process(out, progress, event_id, name):
+    """Scale down the image of an event and make its scaled copies.
+
+    This is run as a task, so out is None.
+    """
+    try:
+        event = FairEvent.objects.get(pk=event_id)
+    except FairEvent.DoesNotExist:
+        return
+    # the image may have been replaced or processed since the job was made
+    if event.image.name != name or event.image_ready:
+        return
+
+    info = imaging.scale_down(event.image, IMG_MAX_D, IMG_MAX_d)
+    if info is None:
+        raise ValueError("Failed to process image {0}".format(name))
+
+    storage = event.image.storage
+    stored = imaging.store_file(event.image.path, storage.location,
+                                IMG_STORE_DIR, info)
+
+    # only if the event still has the same image
+    n = FairEvent.objects.filter(pk=event_id, image=name).update(
+        image=stored, image_width=info.width, image_height=info.height,
+        image_size=info.size, image_hash=info.digest, image_ready=True)
+    # scale_down may have saved it with a different format and file name
+    release([name, event.image.name, stored])
+    if n:
+        event.image = stored
+        event.set_image_info(info)
+        event.image_ready = True
+        event.update_image_sizes()
+    else:
+        logging.getLogger('cams').info(
+            "Event {0} image changed while processing".format(event_id))
+
+jobs.register(JOB_NAME, process, output=False)
+
+# -----------------------------------------------------------------------------
+# signal handlers to delete the image files of the deleted events
+
+def event_deleting(sender, instance, **kwargs):
+    instance._image_files = [instance.image.name]
+    instance._image_files += instance.image_sizes.values_list('name',
+                                                              flat=True)
+
+def event_deleted(sender, instance, **kwargs):
+    release(getattr(instance, '_image_files', []))
+
+for model in [FairEvent, StallEvent]:
+    pre_delete.connect(event_deleting, sender=model)
+    post_delete.connect(event_deleted, sender=model)
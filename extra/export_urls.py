@@ -16,13 +16,15 @@
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.conf.urls import patterns
+from django.conf.urls import patterns, url
 
 urlpatterns = patterns('mrwf.extra.views.export',
  (r'^group/(?P<group_id>\d+)/$', 'group'),
  (r'^group_email/(?P<group_id>\d+)/$', 'group_email'), # Temporary...
  (r'^programme/$', 'programme'),
  (r'^invoices/$', 'invoices'),
+ url(r'^job/(?P<job_id>\d+)/$', 'job', name='export_job'),
+ (r'^job/(?P<job_id>\d+)/file/$', 'job_file'),
 )
 
 urlpatterns += patterns ('mrwf.extra.views.pdfexport',
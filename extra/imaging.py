@@ -18,12 +18,198 @@
 
 import Image
 import os
+import shutil
+import hashlib
+
+REDUCING_GAP = 2
+MIMETYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'GIF': 'image/gif',
+             'WEBP': 'image/webp'}
+EXTENSIONS = {'JPEG': 'jpeg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp'}
+
+class ImageInfo(object):
+    def __init__(self, width, height, size, digest, format=None):
+        self.width = width
+        self.height = height
+        self.size = size
+        self.digest = digest
+        self.format = format
+
+def file_digest(f):
+    h = hashlib.sha1()
+    for chunk in f.chunks():
+        h.update(chunk)
+    return h.hexdigest()
+
+def get_info(img_field):
+    """Get the dimensions, size and content hash of an image field."""
+    try:
+        img = Image.open(img_field)
+        size = img.size
+        return ImageInfo(size[0], size[1], img_field.size,
+                         file_digest(img_field), img.format)
+    except IOError:
+        return None
+
+def scale_file(src_path, dst_path, size):
+    """Save a copy of an image file scaled down to fit in size."""
+    img = Image.open(src_path)
+    img.thumbnail(size, Image.ANTIALIAS)
+    tmp_path = '{0}.{1}.tmp'.format(dst_path, os.getpid())
+    img.save(tmp_path, img.format or 'PNG')
+    os.rename(tmp_path, dst_path)
+    return img.size
+
+def reduce_size(img, new_size):
+    # JPEG images can be decoded directly at a fraction of their size, then
+    # big reductions are done in two steps: a fast one down to twice the
+    # final size and then the antialiased one.
+    if img.format == "JPEG":
+        img.draft(img.mode, new_size)
+    if (img.size[0] > (REDUCING_GAP * new_size[0])) \
+            and (img.mode in ["RGB", "RGBA", "L"]):
+        img = img.resize((new_size[0] * REDUCING_GAP,
+                          new_size[1] * REDUCING_GAP), Image.BILINEAR)
+    return img.resize(new_size, Image.ANTIALIAS)
+
+class Derivative(object):
+    def __init__(self, name, width, height, format):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.format = format
+
+    @property
+    def mimetype(self):
+        return MIMETYPES[self.format]
+
+def get_save_formats():
+    Image.init()
+    return Image.SAVE.keys()
+
+def fit_size(size, max_D):
+    D = max(size)
+    if D <= max_D:
+        return size
+    ratio = float(max_D) / float(D)
+    return (max(1, int(size[0] * ratio)), max(1, int(size[1] * ratio)))
+
+def get_stored_name(dir_name, info):
+    ext = EXTENSIONS.get(info.format, info.format.lower())
+    return os.path.join(dir_name, info.digest[:2],
+                        '{0}.{1}'.format(info.digest, ext))
+
+def store_file(path, root, dir_name, info):
+    """Move an image file to a name made from its content hash.
+
+    The file name relative to root is returned.  If there is already a file
+    with the same contents, it is kept and the other one is removed.
+    """
+    name = get_stored_name(dir_name, info)
+    dst_path = os.path.join(root, name)
+    if os.path.exists(dst_path):
+        os.remove(path)
+    else:
+        if not os.path.isdir(os.path.dirname(dst_path)):
+            os.makedirs(os.path.dirname(dst_path))
+        os.rename(path, dst_path)
+    return name
+
+def make_derivatives(src_path, digest, root, dir_name, sizes, formats):
+    """Make scaled copies of an image in several sizes and formats.
+
+    The files are saved under root/dir_name and named after the content
+    hash of the image and their size, so they are only made once for a
+    given image.  The list of Derivative objects is returned with the file
+    names relative to root, without the sizes larger than the image.
+    """
+    supported = get_save_formats()
+    formats = [f for f in formats if f in supported]
+    orig_size = Image.open(src_path).size
+    new_sizes = []
+    for max_D in sorted(sizes):
+        size = fit_size(orig_size, max_D)
+        if size not in new_sizes:
+            new_sizes.append(size)
+
+    dir_path = os.path.join(root, dir_name)
+    if not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+    derivatives = []
+
+    for size in new_sizes:
+        for format in formats:
+            name = os.path.join(dir_name, '{0}-{1}x{2}.{3}'.format(
+                    digest, size[0], size[1], EXTENSIONS[format]))
+            path = os.path.join(root, name)
+            if not os.path.exists(path):
+                img = Image.open(src_path)
+                if img.size != size:
+                    img = reduce_size(img, size)
+                if format == 'JPEG' and img.mode not in ["RGB", "L"]:
+                    img = img.convert("RGB")
+                tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+                img.save(tmp_path, format)
+                os.rename(tmp_path, path)
+            derivatives.append(Derivative(name, size[0], size[1], format))
+
+    return derivatives
+
+def get_scaled_size(size, max_D, max_d):
+    """Get the size of an image scaled down to fit in max_D x max_d."""
 
-def scale_down(img_field, max_D, max_d):
     if (max_d > max_D):
-        tmp = max_d
-        max_d = max_D
-        max_D = max_d
+        max_D, max_d = max_d, max_D
+
+    if size[0] > size[1]:
+        D = size[0]
+        d = size[1]
+    else:
+        D = size[1]
+        d = size[0]
+
+    if D > max_D:
+        ratio = float(max_D) / float(D)
+        d *= ratio
+    else:
+        ratio = 1.0
+
+    if d > max_d:
+        ratio *= (float(max_d) / float(d))
+
+    return (int(size[0] * ratio), int(size[1] * ratio))
+
+def rescale_file(src_path, dst_path, max_D, max_d):
+    """Save a copy of an image file scaled down if needed.
+
+    The images in other formats than JPEG, PNG and GIF are converted to
+    JPEG as in scale_down.  The ImageInfo of the copy is returned.
+    """
+    img = Image.open(src_path)
+    format = img.format
+    if format not in ("JPEG", "PNG", "GIF"):
+        format = "JPEG"
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        save = True
+    else:
+        save = False
+    new_size = get_scaled_size(img.size, max_D, max_d)
+    if img.size != new_size:
+        img = reduce_size(img, new_size)
+        save = True
+    if save:
+        img.save(dst_path, format)
+    else:
+        shutil.copyfile(src_path, dst_path)
+    h = hashlib.sha1()
+    with open(dst_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), ''):
+            h.update(chunk)
+    return ImageInfo(img.size[0], img.size[1], os.path.getsize(dst_path),
+                     h.hexdigest(), format)
+
+def scale_down(img_field, max_D, max_d):
+    """Scale down the image if needed and return its ImageInfo."""
 
     try:
         file_name = os.path.split(img_field.path)[1]
@@ -37,26 +223,10 @@ def scale_down(img_field, max_D, max_d):
         else:
             save = False
 
-        if img.size[0] > img.size[1]:
-            D = img.size[0]
-            d = img.size[1]
-        else:
-            D = img.size[1]
-            d = img.size[0]
-
-        if D > max_D:
-            ratio = float(max_D) / float(D)
-            d *= ratio
-        else:
-            ratio = 1.0
-
-        if d > max_d:
-            ratio *= (float(max_d) / float(d))
-
-        new_size = (int(img.size[0] * ratio), int(img.size[1] * ratio))
+        new_size = get_scaled_size(img.size, max_D, max_d)
 
         if img.size != new_size:
-            img = img.resize(new_size, Image.ANTIALIAS)
+            img = reduce_size(img, new_size)
             save = True
 
         if save:
@@ -66,11 +236,16 @@ def scale_down(img_field, max_D, max_d):
             img.save(img_field.path, format)
             img_field._size = os.path.getsize(img_field.path)
             img_field._committed = True
+            with open(img_field.path, 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+        else:
+            digest = file_digest(img_field)
 
-        ret = True
+        ret = ImageInfo(img.size[0], img.size[1], img_field.size, digest,
+                        format)
 
     except IOError:
         # ToDo: do not save anything, or save the original?
-        ret = False
+        ret = None
 
     return ret
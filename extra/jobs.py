@@ -0,0 +1,176 @@
+# MRWF - extra/jobs.py
+#
+# Copyright (C) 2009, 2010, 2011. 2012, 2013
+# Guillaume Tucker <guillaume@mangoz.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Queue of the export jobs and tasks run by the export_worker processes.
+
+import os
+import json
+import hashlib
+import datetime
+import logging
+import traceback
+from django.conf import settings
+from django.utils.importlib import import_module
+from mrwf.extra.models import ExportJob, ExportDataVersion
+
+# Modules registering export functions, imported by the workers
+EXPORT_MODULES = ['mrwf.extra.views.export', 'mrwf.extra.views.pdfexport',
+                  'mrwf.extra.eventimages']
+
+# Running jobs older than this are assumed to have been interrupted
+STALE_DELAY = datetime.timedelta(hours=1)
+
+_exports = {}
+_tasks = set()
+
+
+def register(name, func, output=True):
+    _exports[name] = func
+    if not output:
+        _tasks.add(name)
+
+
+def load_exports():
+    for module in EXPORT_MODULES:
+        import_module(module)
+
+
+def get_export(name):
+    if name not in _exports:
+        load_exports()
+    return _exports[name]
+
+
+def get_path(job):
+    return os.path.join(settings.CACHE_PATH, 'export', str(job.pk))
+
+
+def make_key(name, params):
+    return hashlib.sha1(json.dumps([name, params], sort_keys=True)) \
+        .hexdigest()
+
+
+def submit(name, params, file_name, mimetype, user=None):
+    """Get a job for an export, reusing a previous one if possible."""
+    key = make_key(name, params)
+    version = ExportDataVersion.get_version()
+    stale = datetime.datetime.now() - STALE_DELAY
+    jobs = ExportJob.objects.filter(key=key, version=version)
+    jobs = jobs.exclude(status=ExportJob.FAILED)
+
+    for job in jobs.order_by('-pk'):
+        if job.status == ExportJob.DONE:
+            if os.path.exists(get_path(job)):
+                return job
+        elif job.status == ExportJob.PENDING or job.started > stale:
+            return job
+
+    return ExportJob.objects.create(name=name, params=json.dumps(params),
+                                    key=key, version=version,
+                                    file_name=file_name, mimetype=mimetype,
+                                    user=user)
+
+
+def submit_task(name, params):
+    """Get a job for a task, unless the same one is already pending."""
+    key = make_key(name, params)
+    pending = ExportJob.objects.filter(key=key, status=ExportJob.PENDING)
+    for job in pending[:1]:
+        return job
+    return ExportJob.objects.create(name=name, params=json.dumps(params),
+                                    key=key, version=0, file_name='',
+                                    mimetype='')
+
+
+def claim():
+    """Take the oldest pending job, or return None if there isn't any."""
+    # run again the tasks left running by a worker which has crashed, the
+    # exports are submitted again by the users
+    load_exports()
+    stale = datetime.datetime.now() - STALE_DELAY
+    ExportJob.objects.filter(name__in=_tasks, status=ExportJob.RUNNING,
+                             started__lt=stale).update(
+        status=ExportJob.PENDING, started=None)
+
+    pending = ExportJob.objects.filter(status=ExportJob.PENDING)
+    for pk in pending.order_by('pk').values_list('pk', flat=True)[:10]:
+        # only one worker can change the status
+        n = ExportJob.objects.filter(pk=pk, status=ExportJob.PENDING).update(
+            status=ExportJob.RUNNING, started=datetime.datetime.now())
+        if n:
+            return ExportJob.objects.get(pk=pk)
+    return None
+
+
+def purge(job):
+    """Remove the previous jobs of the same export and their files."""
+    old_jobs = ExportJob.objects.filter(key=job.key, pk__lt=job.pk)
+    old_jobs = old_jobs.filter(status__in=[ExportJob.DONE, ExportJob.FAILED])
+    for old_job in old_jobs:
+        try:
+            os.remove(get_path(old_job))
+        except OSError:
+            pass
+    old_jobs.delete()
+
+
+def run(job):
+    path = get_path(job)
+    tmp_path = path + '.tmp'
+    jobs = ExportJob.objects.filter(pk=job.pk)
+    last_progress = [0]
+
+    def progress(done, total):
+        value = (100 * done / total) if total else 0
+        if value != last_progress[0]:
+            jobs.update(progress=value)
+            last_progress[0] = value
+
+    params = dict((str(k), v) for k, v in json.loads(job.params).iteritems())
+
+    try:
+        export = get_export(job.name)
+        if job.name in _tasks:
+            export(None, progress, **params)
+        else:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(tmp_path, 'wb') as out:
+                export(out, progress, **params)
+            os.rename(tmp_path, path)
+    except Exception:
+        logging.getLogger('cams').exception('export job {0}'.format(job.pk))
+        jobs.update(status=ExportJob.FAILED, error=traceback.format_exc(),
+                    finished=datetime.datetime.now())
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+    if job.name in _tasks:
+        jobs.delete()
+        return True
+
+    jobs.update(status=ExportJob.DONE, progress=100,
+                finished=datetime.datetime.now())
+    purge(job)
+    return True
+
+
+def write_chunks(out, chunks):
+    for chunk in chunks:
+        out.write(chunk)
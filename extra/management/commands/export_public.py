@@ -0,0 +1,180 @@
+# MRWF - extra/management/commands/export_public.py
+#
+# Copyright (C) 2009, 2010, 2011. 2012, 2013
+# Guillaume Tucker <guillaume@mangoz.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Static copy of the public programme API, to be served by the front web
+# server.  Each document is written as index.xml and index.json with their
+# compressed copies in the directory of its URL, with prog/current being a
+# link to the directory of the current fair:
+#
+#   prog/index.xml
+#   prog/<year>/index.xml
+#   prog/<year>/dump/index.xml
+#   prog/<year>/categories/index.xml
+#   prog/<year>/<event_id>/index.xml
+#
+# The search and changes endpoints depend on the query so they are not
+# exported, and requests for them need to be passed on to Django.  The fair
+# data versions written are kept in a state file, so the next run only
+# rewrites what has changed since then.
+
+import os
+import json
+import shutil
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.test.client import RequestFactory
+from cams.models import Record, Fair
+from mrwf.extra.models import FairEvent, FairDataVersion, FairEventChange
+from mrwf.extra.public import prog, snapshot
+
+STATE_FILE = '.versions.json'
+
+
+class Command(BaseCommand):
+    args = '<directory>'
+    help = "Export the public programme API as static files."
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help="Rewrite everything, not only what has changed."),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: export_public {0}".format(self.args))
+
+        self.root = os.path.join(args[0], 'prog')
+        self.factory = RequestFactory()
+        self.n_docs = 0
+        snapshot.make_dirs(self.root)
+
+        state_path = os.path.join(args[0], STATE_FILE)
+        if options['all'] or not os.path.exists(state_path):
+            state = {'global': None, 'fairs': {}}
+        else:
+            with open(state_path, 'rb') as f:
+                state = json.load(f)
+
+        global_version = FairDataVersion.get_global().version
+        global_changed = state['global'] != global_version
+        if global_changed:
+            self.write_doc('', prog.all_fairs)
+
+        fairs = {}
+        for fair in Fair.objects.all():
+            key = str(fair.pk)
+            old = state['fairs'].get(key)
+            version = self.export_fair(fair, old, global_changed)
+            fairs[key] = [fair.date.isoformat(), version]
+
+        years = set(date[:4] for date, version in fairs.itervalues())
+        for date, version in state['fairs'].itervalues():
+            if date[:4] not in years:
+                shutil.rmtree(os.path.join(self.root, date[:4]), True)
+
+        self.link_current()
+
+        state = {'global': global_version, 'fairs': fairs}
+        tmp_path = snapshot.get_tmp_path(state_path)
+        with open(tmp_path, 'wb') as f:
+            json.dump(state, f)
+        os.rename(tmp_path, state_path)
+
+        self.stdout.write("{0} documents written\n".format(self.n_docs))
+
+    def export_fair(self, fair, old, global_changed):
+        year = str(fair.date.year)
+        version = FairDataVersion.get_for_fair(pk=fair.pk).version
+
+        # the event documents depend on the fair date
+        if old is not None and old[0] == fair.date.isoformat():
+            old_version = old[1]
+        else:
+            old_version = None
+
+        if global_changed:
+            self.write_doc(os.path.join(year, 'categories'), prog.cats,
+                           fair_year=year)
+
+        if version == old_version:
+            return version
+
+        self.write_doc(year, prog.fair, fair_year=year)
+        self.write_doc(os.path.join(year, 'dump'), prog.dump, fair_year=year)
+
+        events = FairEvent.objects.filter(fair=fair, status=Record.ACTIVE)
+        active = set(events.values_list('main_id', flat=True))
+
+        if old_version is None:
+            main_ids = active
+            fair_dir = os.path.join(self.root, year)
+            removed = [it for it in os.listdir(fair_dir)
+                       if it.isdigit() and int(it) not in active]
+        else:
+            changes = FairEventChange.objects.filter(
+                fair=fair, version__gt=old_version)
+            changed = set(changes.values_list('main_id', flat=True))
+            changed.discard(None)
+            main_ids = changed & active
+            removed = changed - active
+
+        for main_id in main_ids:
+            self.write_doc(os.path.join(year, str(main_id)), prog.event,
+                           fair_year=year, event_id=str(main_id))
+
+        for main_id in removed:
+            shutil.rmtree(os.path.join(self.root, year, str(main_id)), True)
+
+        return version
+
+    def write_doc(self, url_path, view, **kwargs):
+        dir_path = os.path.join(self.root, url_path)
+        snapshot.make_dirs(dir_path)
+
+        for fmt in prog.MIMETYPES.iterkeys():
+            request = self.factory.get('/', {'fmt': fmt})
+            resp = view(request, **kwargs)
+            if resp.status_code != 200:
+                raise CommandError("Failed to export {0}: {1}".format(
+                        url_path, resp.status_code))
+            path = os.path.join(dir_path, 'index.{0}'.format(fmt))
+            tmp_path = snapshot.get_tmp_path(path)
+            with open(tmp_path, 'wb') as f:
+                for chunk in resp:
+                    f.write(chunk)
+            os.rename(tmp_path, path)
+            for encoding, ext in snapshot.ENCODINGS:
+                snapshot.compress(path, encoding)
+
+        self.n_docs += 1
+
+    def link_current(self):
+        link_path = os.path.join(self.root, 'current')
+        current = list(Fair.objects.filter(current=True))
+        if len(current) == 1:
+            year = str(current[0].date.year)
+        else:
+            year = None
+
+        if year is None:
+            if os.path.lexists(link_path):
+                os.remove(link_path)
+        elif not os.path.lexists(link_path) \
+                or os.readlink(link_path) != year:
+            tmp_path = snapshot.get_tmp_path(link_path)
+            os.symlink(year, tmp_path)
+            os.rename(tmp_path, link_path)
@@ -0,0 +1,64 @@
+# MRWF - extra/management/commands/export_worker.py
+#
+# Copyright (C) 2009, 2010, 2011. 2012, 2013
+# Guillaume Tucker <guillaume@mangoz.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import multiprocessing
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+from mrwf.extra import jobs
+
+class Command(NoArgsCommand):
+    help = ("Run the export and image processing jobs as they are "
+            "submitted.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help="Exit when there are no more pending jobs."),
+        make_option('--interval', type='float', dest='interval', default=2.0,
+                    help="Seconds to wait between checks for new jobs."),
+        make_option('--processes', type='int', dest='processes', default=1,
+                    help="Number of worker processes."),
+        )
+
+    def handle_noargs(self, **options):
+        if options['processes'] <= 1:
+            self.work(options)
+            return
+
+        # each process needs its own database connection
+        connection.close()
+        workers = [multiprocessing.Process(target=self.work, args=(options,))
+                   for i in range(options['processes'])]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+    def work(self, options):
+        while True:
+            job = jobs.claim()
+            if job is not None:
+                self.stdout.write("Running job {0}: {1}\n".format(
+                        job.pk, (job.file_name or job.name).encode('utf-8')))
+                jobs.run(job)
+            elif options['once']:
+                break
+            else:
+                # start again with a fresh connection to see the new jobs
+                connection.close()
+                time.sleep(options['interval'])
@@ -0,0 +1,32 @@
+# MRWF - extra/management/commands/fill_event_subtype.py
+#
+# Copyright (C) 2009, 2010, 2011. 2012, 2013
+# Guillaume Tucker <guillaume@mangoz.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import NoArgsCommand
+from mrwf.extra.models import FairEvent, StallEvent
+
+class Command(NoArgsCommand):
+    help = "Set the subtype of the existing fair events."
+
+    def handle_noargs(self, **options):
+        stalls = StallEvent.objects.values('pk')
+        n_stalls = FairEvent.objects.filter(pk__in=stalls).update(
+            subtype=FairEvent.STALL)
+        n_events = FairEvent.objects.exclude(pk__in=stalls).update(
+            subtype=FairEvent.BASIC)
+        self.stdout.write("{0} stalls, {1} other events\n".format(
+                n_stalls, n_events))
@@ -0,0 +1,56 @@
+# MRWF - extra/management/commands/fill_image_info.py
+#
+# Copyright (C) 2009, 2010, 2011. 2012, 2013
+# Guillaume Tucker <guillaume@mangoz.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db.models import Q
+from mrwf.extra.models import FairEvent
+from mrwf.extra import imaging
+
+class Command(NoArgsCommand):
+    help = ("Store the dimensions, size and hash of the event images, and "
+            "make their scaled copies.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help="Also update the events which already have them."),
+        )
+
+    def handle_noargs(self, **options):
+        events = FairEvent.objects.exclude(image='').exclude(image=None)
+        events = events.filter(image_ready=True)
+        if not options['all']:
+            events = events.filter(Q(image_hash='') | Q(image_sizes=None))
+            events = events.distinct()
+
+        n_events = n_errors = 0
+        for e in events.iterator():
+            info = imaging.get_info(e.image)
+            e.image.close()
+            if info is None:
+                self.stderr.write("Failed to read {0}\n".format(e.image.name))
+                n_errors += 1
+                continue
+            FairEvent.objects.filter(pk=e.pk).update(
+                image_width=info.width, image_height=info.height,
+                image_size=info.size, image_hash=info.digest)
+            e.set_image_info(info)
+            e.update_image_sizes()
+            n_events += 1
+
+        self.stdout.write("{0} events updated, {1} errors\n".format(
+                n_events, n_errors))
@@ -0,0 +1,138 @@
+# MRWF - extra/management/commands/process_images.py
+#
+# Copyright (C) 2009, 2010, 2011. 2012, 2013
+# Guillaume Tucker <guillaume@mangoz.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Process all the event images again, for example after changing IMG_SIZES.
+# The state file lets an interrupted run skip the images already done.
+
+import os
+import json
+import hashlib
+import multiprocessing
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+from mrwf.settings import IMG_MAX_D, IMG_MAX_d, IMG_SIZES, IMG_FORMATS
+from mrwf.extra.models import FairEvent, IMG_STORE_DIR, IMG_DERIVED_DIR
+from mrwf.extra import imaging, eventimages
+
+STATE_FILE = 'images.json'
+
+# Number of processed images between each update of the state file
+SAVE_INTERVAL = 20
+
+
+def get_settings_key():
+    formats = [f for f in IMG_FORMATS if f in imaging.get_save_formats()]
+    data = json.dumps([IMG_MAX_D, IMG_MAX_d, sorted(IMG_SIZES), formats])
+    return hashlib.sha1(data).hexdigest()
+
+
+def process_image(item):
+    pk, path, root = item
+    # the stored images may be shared so a new file is always made
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    try:
+        info = imaging.rescale_file(path, tmp_path, IMG_MAX_D, IMG_MAX_d)
+        name = imaging.store_file(tmp_path, root, IMG_STORE_DIR, info)
+        derivatives = imaging.make_derivatives(
+            os.path.join(root, name), info.digest, root, IMG_DERIVED_DIR,
+            IMG_SIZES, IMG_FORMATS)
+    except (IOError, OSError) as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return (pk, None, None, None, str(e))
+    return (pk, name, info, derivatives, None)
+
+
+class Command(NoArgsCommand):
+    help = "Scale all the event images and make their copies again."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help="Also process the images which have not changed."),
+        make_option('--processes', type='int', dest='processes',
+                    default=None, help="Number of processes, one per CPU "
+                    "by default."),
+        )
+
+    def handle_noargs(self, **options):
+        self.state_path = os.path.join(settings.CACHE_PATH, STATE_FILE)
+        if options['all'] or not os.path.exists(self.state_path):
+            self.state = {}
+        else:
+            with open(self.state_path, 'rb') as f:
+                self.state = json.load(f)
+
+        key = get_settings_key()
+        # the images not ready yet are also processed, in case their job
+        # has failed
+        events = FairEvent.objects.exclude(image='').exclude(image=None)
+        todo = {}
+        for e in events.iterator():
+            if not e.image_ready or \
+                    self.state.get(str(e.pk)) != [e.image_hash, key]:
+                todo[e.pk] = e
+
+        items = [(e.pk, e.image.path, e.image.storage.location)
+                 for e in todo.itervalues()]
+        n_events = n_errors = 0
+
+        # the processes do not use the database
+        connection.close()
+        pool = multiprocessing.Pool(options['processes'])
+        try:
+            for i, (pk, name, info, derivatives, error) in \
+                    enumerate(pool.imap_unordered(process_image, items)):
+                e = todo[pk]
+                if error is not None:
+                    self.stderr.write("Failed to process {0}: {1}\n".format(
+                            e.image.name, error))
+                    n_errors += 1
+                elif self.update_event(e, name, info, derivatives):
+                    self.state[str(pk)] = [info.digest, key]
+                    n_events += 1
+                if (i + 1) % SAVE_INTERVAL == 0:
+                    self.save_state()
+        finally:
+            pool.terminate()
+            self.save_state()
+
+        self.stdout.write("{0} events updated, {1} errors\n".format(
+                n_events, n_errors))
+
+    def update_event(self, e, name, info, derivatives):
+        # nothing is changed if the event has had a new image in the meantime
+        old_name = e.image.name
+        n = FairEvent.objects.filter(pk=e.pk, image=old_name).update(
+            image=name, image_width=info.width, image_height=info.height,
+            image_size=info.size, image_hash=info.digest, image_ready=True)
+        if n:
+            e.image = name
+            e.set_image_info(info)
+            e.image_ready = True
+            e.set_image_sizes(derivatives)
+        eventimages.release([old_name, name])
+        return n
+
+    def save_state(self):
+        if not os.path.isdir(settings.CACHE_PATH):
+            os.makedirs(settings.CACHE_PATH)
+        tmp_path = '{0}.{1}.tmp'.format(self.state_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            json.dump(self.state, f)
+        os.rename(tmp_path, self.state_path)
@@ -16,22 +16,51 @@
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import datetime
 from django.db import models
 from django.contrib.auth.models import User
-from django.db.models import (CharField, TextField, DateField, BooleanField,
-                              PositiveIntegerField, PositiveSmallIntegerField,
-                              ForeignKey, OneToOneField, ManyToManyField,
-                              ImageField)
-from cams.models import (Record, Contact, Event, Fair, Person,
+from django.db.models import (CharField, TextField, DateField, DateTimeField,
+                              BooleanField, PositiveIntegerField,
+                              PositiveSmallIntegerField, ForeignKey,
+                              OneToOneField, ManyToManyField, ImageField, F)
+from django.db.models.signals import (pre_save, post_save, pre_delete,
+                                      post_delete, m2m_changed, post_syncdb)
+from django.dispatch import Signal
+from django.core.files.storage import default_storage
+from cams.models import (Record, Contact, Event, Fair, Person, Organisation,
                          Application, EventApplication, Invoice)
 from cams.libcams import get_obj_address
-from mrwf.settings import IMG_MAX_D, IMG_MAX_d
+from mrwf.settings import IMG_SIZES, IMG_FORMATS
 from mrwf.extra import imaging
 
+# Directories of the processed event images and of their scaled copies, in
+# MEDIA_ROOT, with file names made from their content hash
+IMG_STORE_DIR = 'img/store'
+IMG_DERIVED_DIR = 'img/derived'
+
+# Sent with the list of fair ids each time their programme data has changed
+prog_changed = Signal(providing_args=['fair_ids'])
+
 # WORKAROUND for temporary fix with the event contacts
 from django.db.models import EmailField, URLField, IntegerField
 from cams.models import Contact
 
+CONTACT_ATTRS = ['line_1', 'line_2', 'line_3', 'postcode', 'town', 'country',
+                 'email', 'website', 'telephone', 'mobile', 'fax',
+                 'addr_order', 'addr_suborder']
+
+
+class CompositeContact(object):
+    """Light-weight copy of a fair event contact, see FairEventContact."""
+    __slots__ = CONTACT_ATTRS
+
+    def __init__(self, values):
+        for att in CONTACT_ATTRS:
+            setattr(self, att, values.get(att, ''))
+
+    def get_address(self, *args):
+        return get_obj_address(self, *args)
+
 class FairEventType(models.Model):
     name = CharField(max_length=63)
     tag = CharField(max_length=3)
@@ -57,7 +86,13 @@ class FairEventCategory(models.Model):
 
 
 class FairEvent(Event):
+    BASIC = 0
+    STALL = 1
+    xsubtype = ((BASIC, 'event'), (STALL, 'stall'))
+
     event = OneToOneField(Event, parent_link=True)
+    subtype = PositiveSmallIntegerField(choices=xsubtype, default=BASIC,
+                                        editable=False)
     etype = ForeignKey(FairEventType, blank=True, null=True,
                        verbose_name="Listing")
     categories = ManyToManyField(FairEventCategory, null=True, blank=True)
@@ -66,6 +101,13 @@ class FairEvent(Event):
     # http://code.djangoproject.com/ticket/7048
     # http://code.djangoproject.com/ticket/4979
     image = ImageField(upload_to='img', blank=True, null=True)
+    image_width = PositiveIntegerField(blank=True, null=True, editable=False)
+    image_height = PositiveIntegerField(blank=True, null=True, editable=False)
+    image_size = PositiveIntegerField(blank=True, null=True, editable=False)
+    image_hash = CharField(max_length=40, blank=True, editable=False)
+    image_ready = BooleanField(default=False, editable=False)
+    image_source_hash = CharField(max_length=40, blank=True, editable=False,
+                                  db_index=True)
     age_min = PositiveIntegerField(blank=True, null=True)
     age_max = PositiveIntegerField(blank=True, null=True)
 
@@ -98,39 +140,142 @@ class FairEvent(Event):
             self.fair = Fair.objects.get(current=True)
         if not self.date:
             self.date = self.fair.date
-        if self.image:
-            imaging.scale_down(self.image, IMG_MAX_D, IMG_MAX_d)
+        # Only set it here as a stall may also be saved as a FairEvent
+        if isinstance(self, StallEvent):
+            self.subtype = FairEvent.STALL
+        old_hash = self.image_hash
+        old_name = None
+        if not (self.image and self.image._committed and self.image_ready):
+            # the image is new, not processed yet or has been removed
+            if self.pk and (self.image or self.image_ready):
+                names = FairEvent.objects.filter(pk=self.pk).values_list(
+                    'image', flat=True)
+                old_name = names[0] if names else None
+            if self.image:
+                eventimages.prepare(self)
+            else:
+                self.set_image_info(None)
+                self.image_source_hash = ''
+                self.image_ready = False
         super(FairEvent, self).save(args, kwargs)
+        if self.image_hash != old_hash:
+            self.update_image_sizes()
+        if self.image and not self.image_ready:
+            eventimages.submit(self)
+        if old_name and old_name != self.image.name:
+            eventimages.release([old_name])
 
-    # WORKAROUND to make the event contacts more flexible
-    def get_composite_contact(self):
-        class CompositeContact(object):
-            def __init__(self, event):
-                attrs = ['line_1', 'line_2', 'line_3', 'postcode', 'town',
-                         'country', 'email', 'website', 'telephone', 'mobile',
-                         'fax', 'addr_order', 'addr_suborder']
-
-                if event.ignore_org_c:
-                    for att in attrs:
-                        setattr(self, att, getattr(event, att, ''))
-                else:
-                    if event.org and event.org.contact_set.count() > 0:
-                        org_c = event.org.contact_set.all()[0]
-                    else:
-                        org_c = None
-
-                    for att in attrs:
-                        value = getattr(event, att, '')
-
-                        if org_c and not value:
-                            value = getattr(org_c, att, '')
-
-                        setattr(self, att, value)
+    @property
+    def subtype_str(self):
+        return FairEvent.xsubtype[self.subtype][1]
+
+    def set_image_info(self, info):
+        if info is None:
+            self.image_width = self.image_height = self.image_size = None
+            self.image_hash = ''
+        else:
+            self.image_width = info.width
+            self.image_height = info.height
+            self.image_size = info.size
+            self.image_hash = info.digest
+
+    def get_image_dimensions(self):
+        # Only open the file if the dimensions have not been stored yet
+        if self.image_width is None or self.image_height is None:
+            return (self.image.width, self.image.height)
+        return (self.image_width, self.image_height)
+
+    def update_image_sizes(self):
+        """Make the scaled copies of the image and store their details."""
+        if self.image and self.image_ready:
+            derivatives = imaging.make_derivatives(
+                self.image.path, self.image_hash, self.image.storage.location,
+                IMG_DERIVED_DIR, IMG_SIZES, IMG_FORMATS)
+        else:
+            derivatives = []
+        self.set_image_sizes(derivatives)
+
+    def set_image_sizes(self, derivatives):
+        """Store the details of the scaled copies of the image."""
+        old_names = list(self.image_sizes.values_list('name', flat=True))
+        self.image_sizes.all().delete()
+        FairEventImageSize.objects.bulk_create([
+                FairEventImageSize(event=self, name=d.name, width=d.width,
+                                   height=d.height, mimetype=d.mimetype)
+                for d in derivatives])
+        eventimages.release(old_names)
+        # the version was bumped by post_save before the sizes were stored
+        events_changed([self])
 
-            def get_address(self, *args):
-                return get_obj_address(self, *args)
+    # WORKAROUND to make the event contacts more flexible
+    def resolve_contact(self, org_contacts=None):
+        """Merge the event address fields with the organisation contact.
+
+        The merged values are returned in a dictionary.  If org_contacts is
+        provided, it must be a dictionary as returned by
+        FairEvent.get_org_contacts and no query is run to find the
+        organisation contact.
+        """
+        if self.ignore_org_c or not self.org_id:
+            org_c = None
+        elif org_contacts is not None:
+            org_c = org_contacts.get(self.org_id)
+        else:
+            org_c = FairEvent.get_org_contacts([self.org_id]).get(self.org_id)
+
+        values = {}
+        for att in CONTACT_ATTRS:
+            value = getattr(self, att, '')
+            if org_c and not value:
+                value = getattr(org_c, att, '')
+            values[att] = value
+        return values
+
+    def get_composite_contact(self, org_contacts=None):
+        """Get the event contact merged with the organisation contact.
+
+        It is normally read from the FairEventContact table, and only worked
+        out with resolve_contact and stored if not there yet.
+        """
+        if self.pk is None:
+            return FairEventContact(**self.resolve_contact(org_contacts))
+        try:
+            return self.resolved_contact
+        except FairEventContact.DoesNotExist:
+            return FairEventContact.refresh([self], org_contacts)[0]
 
-        return CompositeContact(self)
+    @classmethod
+    def get_composite_contacts(cls, events):
+        """Get the composite contacts of several events at once.
+
+        A dictionary with a CompositeContact for each event id is returned.
+        The stored contacts are read in a single query, and the missing ones
+        are worked out and stored with three more queries (see
+        FairEventContact.refresh).
+        """
+        events = list(events)
+        contacts = {}
+        rows = FairEventContact.objects.filter(
+            event__in=[e.pk for e in events])
+        for values in rows.values('event', *CONTACT_ATTRS):
+            contacts[values['event']] = CompositeContact(values)
+        missing = [e for e in events if e.pk not in contacts]
+        if missing:
+            for c in FairEventContact.refresh(missing):
+                contacts[c.event_id] = CompositeContact(vars(c))
+        return contacts
+
+    @staticmethod
+    def get_org_contacts(org_ids):
+        """Get the first contact of each organisation in a single query.
+
+        This works the same with the ids of any contactables, such as the
+        event owners.
+        """
+        org_contacts = {}
+        for c in Contact.objects.filter(obj__in=org_ids):
+            org_contacts.setdefault(c.obj_id, c)
+        return org_contacts
 
     @classmethod
     def get_for_fair(cls, event_id, fair):
@@ -223,6 +368,73 @@ class StallEvent(FairEvent):
         return StallEvent.xmcstall[self.mc_stall_option][1]
 
 
+class FairEventImageSize(models.Model):
+    """Scaled copy of a fair event image, made by update_image_sizes."""
+    event = ForeignKey(FairEvent, related_name='image_sizes')
+    name = CharField(max_length=255)
+    width = PositiveIntegerField()
+    height = PositiveIntegerField()
+    mimetype = CharField(max_length=31)
+
+    class Meta:
+        ordering = ['width', 'mimetype']
+
+    def __unicode__(self):
+        return self.name
+
+    @property
+    def url(self):
+        return default_storage.url(self.name)
+
+
+class FairEventContact(models.Model):
+    """Contact of a fair event merged with the organisation contact.
+
+    This is what FairEvent.get_composite_contact returns, kept up to date by
+    the signal handlers below when the event, its organisation or one of the
+    organisation contacts is changed.
+    """
+    event = OneToOneField(FairEvent, primary_key=True,
+                          related_name='resolved_contact')
+    line_1 = CharField(max_length=63, blank=True)
+    line_2 = CharField(max_length=63, blank=True)
+    line_3 = CharField(max_length=63, blank=True)
+    town = CharField(max_length=63, blank=True)
+    postcode = CharField(max_length=15, blank=True)
+    country = CharField(max_length=63, blank=True)
+    email = EmailField(blank=True, max_length=127)
+    website = URLField(max_length=255, blank=True)
+    telephone = CharField(max_length=127, blank=True)
+    mobile = CharField(max_length=127, blank=True)
+    fax = CharField(max_length=31, blank=True)
+    addr_order = IntegerField(blank=True, null=True)
+    addr_suborder = IntegerField(blank=True, null=True)
+
+    def __unicode__(self):
+        return self.get_address()
+
+    def get_address(self, *args):
+        return get_obj_address(self, *args)
+
+    @classmethod
+    def refresh(cls, events, org_contacts=None):
+        """Work out and store the contacts of the given events.
+
+        The old rows are deleted and the new ones inserted with two queries,
+        plus one for the organisation contacts if they are not given.
+        """
+        events = list(events)
+        if org_contacts is None:
+            org_contacts = FairEvent.get_org_contacts(
+                set(e.org_id for e in events
+                    if e.org_id and not e.ignore_org_c))
+        contacts = [cls(event_id=e.pk, **e.resolve_contact(org_contacts))
+                    for e in events]
+        cls.objects.filter(event__in=[e.pk for e in events]).delete()
+        cls.objects.bulk_create(contacts)
+        return contacts
+
+
 class FairEventApplication(EventApplication):
     STALLHOLDER = 0
     ADVERTISER = 1
@@ -275,3 +487,286 @@ class StallInvoice(Invoice):
 
     class Meta(Invoice.Meta):
         ordering = ['stall__name']
+
+
+class FairDataVersion(models.Model):
+    """Version of the public programme data of a fair.
+
+    It is bumped each time something that appears in the programme of the
+    fair is changed.  The entry without any fair is the global version,
+    bumped on every change.
+    """
+    fair = OneToOneField(Fair, blank=True, null=True)
+    version = PositiveIntegerField(default=0)
+    modified = DateTimeField(default=datetime.datetime.now)
+
+    def __unicode__(self):
+        return u'{0} v{1}'.format(self.fair or 'global', self.version)
+
+    @property
+    def etag(self):
+        return '{0}-{1}'.format(self.fair_id or 0, self.version)
+
+    @classmethod
+    def bump(cls, fair_ids=None):
+        """Bump the version of the given fairs, or all of them if None."""
+        if fair_ids is None:
+            fair_ids = Fair.objects.values_list('pk', flat=True)
+        else:
+            fair_ids = get_existing_fair_ids(fair_ids)
+        fair_ids = set(fair_ids)
+        now = datetime.datetime.now()
+        for fair_id in fair_ids | set([None]):
+            n = cls.objects.filter(fair=fair_id).update(
+                version=F('version') + 1, modified=now)
+            if n == 0:
+                # the global version is normally made by syncdb
+                cls.objects.create(fair_id=fair_id, version=1, modified=now)
+        if fair_ids:
+            prog_changed.send(sender=cls, fair_ids=fair_ids)
+
+    @classmethod
+    def get_for_fair(cls, **fair_lookup):
+        """Get the version of the fair matching fair_lookup, or None."""
+        lookup = dict(('fair__' + k, v) for k, v in fair_lookup.iteritems())
+        try:
+            return cls.objects.get(**lookup)
+        except cls.DoesNotExist:
+            pass
+        except cls.MultipleObjectsReturned:
+            return None
+        try:
+            fair = Fair.objects.get(**fair_lookup)
+        except (Fair.DoesNotExist, Fair.MultipleObjectsReturned):
+            return None
+        return cls.objects.get_or_create(fair=fair)[0]
+
+    @classmethod
+    def get_global(cls):
+        # there may be more than one if it was not made by syncdb
+        versions = cls.objects.filter(fair__isnull=True).order_by('pk')
+        for version in versions[:1]:
+            return version
+        return cls.objects.create()
+
+
+class FairEventChange(models.Model):
+    """Latest change of each fair event, used by the public delta sync.
+
+    The version is the one of the fair data after the change, and deleted
+    entries are kept as tombstones.
+    """
+    event_id = PositiveIntegerField(unique=True)
+    main_id = PositiveIntegerField(blank=True, null=True)
+    fair = ForeignKey(Fair)
+    version = PositiveIntegerField(db_index=True)
+    modified = DateTimeField(default=datetime.datetime.now)
+    deleted = BooleanField(default=False)
+
+    def __unicode__(self):
+        return u'{0} v{1}'.format(self.event_id, self.version)
+
+    @classmethod
+    def record(cls, event, deleted=False):
+        versions = FairDataVersion.objects.filter(fair=event.fair_id)
+        versions = list(versions.values_list('version', flat=True))
+        if not versions:
+            # the fair has been deleted
+            return
+        version = versions[0]
+        fields = {'fair': event.fair_id, 'main_id': event.main_id,
+                  'version': version, 'deleted': deleted,
+                  'modified': datetime.datetime.now()}
+        n = cls.objects.filter(event_id=event.pk).update(**fields)
+        if n == 0:
+            fields['fair_id'] = fields.pop('fair')
+            cls.objects.create(event_id=event.pk, **fields)
+
+class ExportDataVersion(models.Model):
+    """Version of the data used by the exports.
+
+    There is only one entry, bumped each time anything is changed in the
+    cams or extra models so export files can be reused until then.
+    """
+    version = PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return u'v{0}'.format(self.version)
+
+    @classmethod
+    def bump(cls):
+        if cls.objects.update(version=F('version') + 1) == 0:
+            cls.objects.create(pk=1, version=1)
+
+    @classmethod
+    def get_version(cls):
+        return cls.objects.get_or_create(pk=1)[0].version
+
+
+class ExportJob(models.Model):
+    """Export file produced in the background, see mrwf.extra.jobs."""
+    PENDING = 0
+    RUNNING = 1
+    DONE = 2
+    FAILED = 3
+    xstatus = ((PENDING, 'pending'), (RUNNING, 'running'), (DONE, 'done'),
+               (FAILED, 'failed'))
+
+    name = CharField(max_length=31)
+    params = TextField()
+    key = CharField(max_length=40, db_index=True)
+    version = PositiveIntegerField()
+    file_name = CharField(max_length=255)
+    mimetype = CharField(max_length=63)
+    user = ForeignKey(User, blank=True, null=True)
+    status = PositiveSmallIntegerField(choices=xstatus, default=PENDING)
+    progress = PositiveSmallIntegerField(default=0)
+    error = TextField(blank=True)
+    created = DateTimeField(default=datetime.datetime.now)
+    started = DateTimeField(blank=True, null=True)
+    finished = DateTimeField(blank=True, null=True)
+
+    def __unicode__(self):
+        return u'{0} ({1})'.format(self.file_name, self.status_str)
+
+    @property
+    def status_str(self):
+        return ExportJob.xstatus[self.status][1]
+
+    @property
+    def is_active(self):
+        return self.status in [ExportJob.PENDING, ExportJob.RUNNING]
+
+# -----------------------------------------------------------------------------
+# signal handlers to keep the resolved event contacts up to date
+
+def event_contact_changed(sender, instance, **kwargs):
+    if sender is Event:
+        FairEventContact.refresh(FairEvent.objects.filter(pk=instance.pk))
+    else:
+        FairEventContact.refresh([instance])
+
+def org_contact_changed(sender, instance, **kwargs):
+    if sender is Contact:
+        org_id = instance.obj_id
+    else:
+        org_id = instance.pk
+    if org_id:
+        FairEventContact.refresh(FairEvent.objects.filter(org=org_id))
+
+def create_event_contacts(sender, created_models, **kwargs):
+    if FairEventContact in created_models:
+        FairEventContact.refresh(FairEvent.objects.all())
+
+# connected first so the contacts are up to date for the handlers below
+for model in [Event, FairEvent, StallEvent]:
+    post_save.connect(event_contact_changed, sender=model)
+for sig in [post_save, post_delete]:
+    sig.connect(org_contact_changed, sender=Organisation)
+    sig.connect(org_contact_changed, sender=Contact)
+post_syncdb.connect(create_event_contacts)
+
+# -----------------------------------------------------------------------------
+# signal handlers to keep track of the programme changes
+
+def get_existing_fair_ids(fair_ids):
+    # When a fair is deleted, the post_delete signals of its events are sent
+    # after all the rows have been deleted so its id needs to be skipped.
+    fair_ids = set(fair_ids)
+    if not fair_ids:
+        return fair_ids
+    return set(Fair.objects.filter(pk__in=fair_ids).values_list('pk',
+                                                                 flat=True))
+
+def events_changed(events, deleted=False):
+    """Bump the data version of the fairs and log the event changes."""
+    fair_ids = get_existing_fair_ids(e.fair_id for e in events if e.fair_id)
+    events = [e for e in events if e.fair_id in fair_ids]
+    FairDataVersion.bump(fair_ids)
+    for e in events:
+        FairEventChange.record(e, deleted)
+
+def event_saved(sender, instance, **kwargs):
+    # Event is saved directly by FairEventApplication.save
+    if sender is Event:
+        if not FairEvent.objects.filter(pk=instance.pk).exists():
+            return
+    events_changed([instance])
+
+def event_deleted(sender, instance, **kwargs):
+    events_changed([instance], deleted=True)
+
+def event_categories_changed(sender, instance, action, reverse, pk_set,
+                             **kwargs):
+    if action not in ['post_add', 'post_remove', 'post_clear']:
+        return
+    if not reverse:
+        events_changed([instance])
+    elif pk_set is None:
+        FairDataVersion.bump()
+    else:
+        events_changed(FairEvent.objects.filter(pk__in=pk_set))
+
+def category_changed(sender, instance, **kwargs):
+    events_changed(FairEvent.objects.filter(categories=instance))
+
+def fair_saving(sender, instance, **kwargs):
+    dates = Fair.objects.filter(pk=instance.pk).values_list('date', flat=True)
+    instance._old_date = dates[0] if dates else None
+
+def fair_saved(sender, instance, created, **kwargs):
+    # the events are exported with the date of their fair
+    if not created and getattr(instance, '_old_date', None) != instance.date:
+        events_changed(FairEvent.objects.filter(fair=instance.pk))
+    else:
+        FairDataVersion.bump([instance.pk])
+
+def fair_deleted(sender, instance, **kwargs):
+    FairDataVersion.bump([])
+
+def create_global_version(sender, created_models, **kwargs):
+    # made once here as the fair is not unique when it is None
+    if FairDataVersion in created_models:
+        FairDataVersion.objects.create()
+
+def org_changed(sender, instance, **kwargs):
+    events_changed(FairEvent.objects.filter(org=instance.pk))
+
+def contact_changed(sender, instance, **kwargs):
+    if instance.obj_id:
+        events_changed(FairEvent.objects.filter(org=instance.obj_id))
+
+for model in [Event, FairEvent, StallEvent]:
+    post_save.connect(event_saved, sender=model)
+for model in [FairEvent, StallEvent]:
+    post_delete.connect(event_deleted, sender=model)
+for sig in [post_save, post_delete]:
+    sig.connect(org_changed, sender=Organisation)
+    sig.connect(contact_changed, sender=Contact)
+
+post_save.connect(category_changed, sender=FairEventCategory)
+pre_delete.connect(category_changed, sender=FairEventCategory)
+pre_save.connect(fair_saving, sender=Fair)
+post_save.connect(fair_saved, sender=Fair)
+post_syncdb.connect(create_global_version)
+post_delete.connect(fair_deleted, sender=Fair)
+m2m_changed.connect(event_categories_changed,
+                    sender=FairEvent.categories.through)
+
+# -----------------------------------------------------------------------------
+# signal handler to track the changes of the exported data
+
+EXPORT_IGNORED = [ExportDataVersion, ExportJob, FairDataVersion,
+                  FairEventChange, FairEventContact, FairEventImageSize]
+
+def export_data_changed(sender, **kwargs):
+    if kwargs.get('action', 'post_').startswith('post_') \
+            and sender._meta.app_label in ['cams', 'extra'] \
+            and sender not in EXPORT_IGNORED:
+        ExportDataVersion.bump()
+
+for sig in [post_save, post_delete, m2m_changed]:
+    sig.connect(export_data_changed)
+
+# connect the full-text search index signal handlers
+from mrwf.extra import search, eventimages
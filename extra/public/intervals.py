@@ -0,0 +1,102 @@
+# MRWF - extra/public/intervals.py
+#
+# Copyright (C) 2009, 2010, 2011. 2012, 2013
+# Guillaume Tucker <guillaume@mangoz.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# In-process index of the event times and ages used by the public search.
+
+import threading
+from bisect import bisect_left, bisect_right
+from mrwf.extra.models import FairEvent
+
+# Number of results memoised by each index, as the values come from the
+# requests: it is enough for all the hours and the usual ages
+MAX_RESULTS = 128
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+class IntervalIndex(object):
+    """Set of [low, high] intervals with None meaning unbounded."""
+
+    def __init__(self, intervals):
+        lows = []
+        highs = []
+        self._no_low = set()
+        self._no_high = set()
+
+        for pk, low, high in intervals:
+            if low is None:
+                self._no_low.add(pk)
+            else:
+                lows.append((low, pk))
+            if high is None:
+                self._no_high.add(pk)
+            else:
+                highs.append((high, pk))
+
+        lows.sort()
+        highs.sort()
+        self._low_keys = [it[0] for it in lows]
+        self._low_ids = [it[1] for it in lows]
+        self._high_keys = [it[0] for it in highs]
+        self._high_ids = [it[1] for it in highs]
+        self._results = {}
+
+    def containing(self, value):
+        """Get the set of ids with low <= value <= high."""
+        ids = self._results.get(value)
+        if ids is None:
+            i = bisect_right(self._low_keys, value)
+            started = self._no_low.union(self._low_ids[:i])
+            j = bisect_left(self._high_keys, value)
+            not_ended = self._no_high.union(self._high_ids[j:])
+            ids = frozenset(started & not_ended)
+            if len(self._results) < MAX_RESULTS:
+                self._results[value] = ids
+        return ids
+
+
+class FairIndex(object):
+    def __init__(self, fair):
+        events = FairEvent.objects.filter(fair=fair)
+        rows = list(events.values_list('pk', 'time', 'end_time',
+                                       'age_min', 'age_max'))
+        self.times = IntervalIndex((it[0], it[1], it[2]) for it in rows)
+        self.ages = IntervalIndex((it[0], it[3], it[4]) for it in rows)
+
+    def running_at(self, time):
+        return self.times.containing(time)
+
+    def suitable_for(self, age):
+        return self.ages.containing(age)
+
+
+def get_index(fair, version):
+    """Get the index of a fair, rebuilt if the version has changed."""
+    with _cache_lock:
+        cached = _cache.get(fair.pk)
+
+    if cached is not None and version is not None \
+            and cached[0] == version.version:
+        return cached[1]
+
+    index = FairIndex(fair)
+    if version is not None:
+        with _cache_lock:
+            _cache[fair.pk] = (version.version, index)
+    return index
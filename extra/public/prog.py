@@ -16,131 +16,316 @@
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import time
 import datetime
-from xml.dom.minidom import getDOMImplementation
+import json
+from functools import wraps
+from itertools import chain
 from django.http import HttpResponse, Http404
 from django.db.models.query import Q
 from django.shortcuts import render_to_response, get_object_or_404
+from django.views.decorators.http import condition
+from django.core.servers.basehttp import FileWrapper
+from django.utils.cache import patch_vary_headers
 from cams.models import Record, Person, Organisation, Contact, Event, Fair
 from cams.libcams import str2list
-from mrwf.extra.models import FairEvent, FairEventCategory
-
-def add_date_ele (doc, root, tag, date):
-    ele = doc.createElement (tag)
-    root.appendChild (ele)
-    ele.setAttribute ('year', str (date.year))
-    ele.setAttribute ('month', str (date.month))
-    ele.setAttribute ('day', str (date.day))
-
-def add_time_ele (doc, root, tag, time):
-    ele = doc.createElement (tag)
-    root.appendChild (ele)
-    ele.setAttribute ('hour', str (time.hour))
-    ele.setAttribute ('minute', str (time.minute))
+from mrwf.extra.models import (FairEvent, FairEventCategory, FairDataVersion,
+                               FairEventChange)
+from mrwf.extra import search as fulltext
+from mrwf.extra.public.xmlstream import Element, stream_document
+from mrwf.extra.public import snapshot, intervals
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # Django < 1.5 streams any iterator passed to HttpResponse
+    StreamingHttpResponse = HttpResponse
+
+MIMETYPES = {'xml': 'application/xml', 'json': 'application/json'}
+DUMP_CHUNK_SIZE = 200
+ADDRESS_FIELDS = ['line_1', 'line_2', 'line_3', 'town', 'postcode',
+                  'website', 'email', 'telephone', 'mobile', 'addr_order',
+                  'addr_suborder']
+
+def add_date_ele (root, tag, date):
+    ele = root.add (tag)
+    ele.set ('year', str (date.year))
+    ele.set ('month', str (date.month))
+    ele.set ('day', str (date.day))
+
+def add_time_ele (root, tag, time):
+    ele = root.add (tag)
+    ele.set ('hour', str (time.hour))
+    ele.set ('minute', str (time.minute))
 
 def populate_event_id (ele, event):
-    ele.setAttribute ('id', str (event.main_id))
-    ele.setAttribute ('name', event.name)
+    ele.set ('id', str (event.main_id))
+    ele.set ('name', event.name)
 
-def add_event_id_ele (doc, root, tag, event):
-    ele = doc.createElement (tag)
-    root.appendChild (ele)
-    populate_event_id (ele, event)
-
-def populate_event_ele (doc, ele, event):
+def populate_event_ele (ele, event):
     populate_event_id (ele, event)
 
     # listing attribute ...
 #    if event.etype:
-#        root.setAttribute ('type', event.etype.name)
+#        root.set ('type', event.etype.name)
 
     if event.location:
-        ele.setAttribute ('venue', event.location)
+        ele.set ('venue', event.location)
     elif event.org:
-        ele.setAttribute ('venue', event.org.name)
+        ele.set ('venue', event.org.name)
 
     if event.description:
-        desc_ele = doc.createElement ('description')
-        ele.appendChild (desc_ele)
-        desc_txt = doc.createTextNode (event.description)
-        desc_ele.appendChild (desc_txt)
-
-    if event.image:
-        img = doc.createElement ('image')
-        ele.appendChild (img)
-        img.setAttribute ('url', event.image.url)
-        img.setAttribute ('width', str (event.image.width))
-        img.setAttribute ('height', str (event.image.height))
+        desc_ele = ele.add ('description')
+        desc_ele.text = event.description
+
+    if event.image and event.image_ready:
+        width, height = event.get_image_dimensions ()
+        img = ele.add ('image')
+        img.set ('url', event.image.url)
+        img.set ('width', str (width))
+        img.set ('height', str (height))
+        for it in event.image_sizes.all ():
+            size = img.add ('size')
+            size.set ('url', it.url)
+            size.set ('width', str (it.width))
+            size.set ('height', str (it.height))
+            size.set ('type', it.mimetype)
 
     if event.date != event.fair.date:
-        add_date_ele (doc, ele, 'date', event.date)
+        add_date_ele (ele, 'date', event.date)
 
     if event.end_date:
-        add_date_ele (doc, ele, 'end_date', event.end_date)
+        add_date_ele (ele, 'end_date', event.end_date)
 
     if event.time:
-        add_time_ele (doc, ele, 'time', event.time)
+        add_time_ele (ele, 'time', event.time)
 
     if event.end_time:
-        add_time_ele (doc, ele, 'end_time', event.end_time)
+        add_time_ele (ele, 'end_time', event.end_time)
 
     if event.age_min or event.age_max:
-        age = doc.createElement ('age')
-        ele.appendChild (age)
+        age = ele.add ('age')
         if event.age_min:
-            age.setAttribute ('min', str (event.age_min))
+            age.set ('min', str (event.age_min))
 
         if event.age_max:
-            age.setAttribute ('max', str (event.age_max))
+            age.set ('max', str (event.age_max))
 
     for cat in event.categories.all ():
-        cat_ele = doc.createElement ('category')
-        ele.appendChild (cat_ele)
-        cat_ele.setAttribute ('id', str (cat.pk))
-        cat_ele.setAttribute ('name', cat.word)
+        cat_ele = ele.add ('category')
+        cat_ele.set ('id', str (cat.pk))
+        cat_ele.set ('name', cat.word)
+
+    # WORKAROUND
+    c = event.get_composite_contact ()
+    addr_ele = ele.add ('address')
+
+    for it in ADDRESS_FIELDS:
+        addr_ele.set (it, str (getattr (c, it, '')))
+
+def make_event_ele (event):
+    ele = Element ('event')
+    populate_event_ele (ele, event)
+    return ele
+
+def make_event_id_ele (event):
+    ele = Element ('event')
+    populate_event_id (ele, event)
+    return ele
+
+def make_fair_root (fair):
+    root = Element ('events')
+    root.set ('year', str (fair.date.year))
+    root.set ('month', str (fair.date.month))
+    root.set ('day', str (fair.date.day))
+    return root
+
+# -----------------------------------------------------------------------------
+# JSON representation, with the same fields as the XML one
+
+def date_dict (date):
+    return {'year': date.year, 'month': date.month, 'day': date.day}
+
+def time_dict (time):
+    return {'hour': time.hour, 'minute': time.minute}
+
+def event_id_dict (event):
+    return {'id': event.main_id, 'name': event.name}
+
+def event_dict (event):
+    d = event_id_dict (event)
+
+    if event.location:
+        d['venue'] = event.location
+    elif event.org:
+        d['venue'] = event.org.name
+
+    if event.description:
+        d['description'] = event.description
+
+    if event.image and event.image_ready:
+        width, height = event.get_image_dimensions ()
+        d['image'] = {'url': event.image.url, 'width': width,
+                      'height': height}
+        d['image']['sizes'] = [{'url': it.url, 'width': it.width,
+                                'height': it.height, 'type': it.mimetype}
+                               for it in event.image_sizes.all ()]
+
+    if event.date != event.fair.date:
+        d['date'] = date_dict (event.date)
+
+    if event.end_date:
+        d['end_date'] = date_dict (event.end_date)
+
+    if event.time:
+        d['time'] = time_dict (event.time)
+
+    if event.end_time:
+        d['end_time'] = time_dict (event.end_time)
+
+    if event.age_min or event.age_max:
+        age = d['age'] = {}
+        if event.age_min:
+            age['min'] = event.age_min
+
+        if event.age_max:
+            age['max'] = event.age_max
+
+    d['categories'] = [cat_dict (cat) for cat in event.categories.all ()]
 
     # WORKAROUND
     c = event.get_composite_contact ()
-    addr_ele = doc.createElement ('address')
+    d['address'] = dict ((it, getattr (c, it, '')) for it in ADDRESS_FIELDS)
+
+    return d
+
+def cat_dict (cat):
+    return {'id': cat.pk, 'name': cat.word}
+
+def fair_dict (fair):
+    return {'current': bool (fair.current), 'date': date_dict (fair.date)}
+
+def to_json (obj):
+    return json.dumps (obj, separators = (',', ':'))
 
-    for it in ['line_1', 'line_2', 'line_3', 'town', 'postcode', 'website',
-               'email', 'telephone', 'mobile', 'addr_order', 'addr_suborder']:
-        addr_ele.setAttribute (it, str (getattr (c, it, '')))
+def stream_json (root, key, items):
+    # root is a dictionary, serialized with an extra key for the list of items
+    head = to_json (root)[:-1]
+    if root:
+        head += ','
+    yield '{0}"{1}":['.format (head, key)
+    sep = ''
+    for it in items:
+        yield sep + to_json (it)
+        sep = ','
+    yield ']}'
+
+# -----------------------------------------------------------------------------
+
+def get_pretty (request):
+    return request.GET.get ('layout') != 'compact'
+
+def get_fmt (request):
+    fmt = request.GET.get ('fmt', 'xml')
+    if fmt not in MIMETYPES:
+        raise Http404
+    return fmt
 
-    ele.appendChild (addr_ele)
+def stream_response (stream, fmt):
+    return StreamingHttpResponse (stream, mimetype = MIMETYPES[fmt])
 
-def fair_obj (fair, dump):
+def list_response (request, root_ele, root_dict, key, items,
+                   make_ele, make_dict):
+    fmt = get_fmt (request)
+    if fmt == 'json':
+        stream = stream_json (root_dict, key, (make_dict (it) for it in items))
+    else:
+        stream = stream_document (root_ele, (make_ele (it) for it in items),
+                                  get_pretty (request))
+    return stream_response (stream, fmt)
+
+def iterate_dump_events (events, make):
+    # Load everything populate_event_ele needs in a fixed number of queries
+    # per chunk of events: events with their fair, organisation and resolved
+    # contact, and then the categories and image sizes.
+    pks = list (events.values_list ('pk', flat = True))
+    events = events.select_related ('fair', 'org', 'resolved_contact')
+    events = events.prefetch_related ('categories', 'image_sizes')
+    for i in range (0, len (pks), DUMP_CHUNK_SIZE):
+        for it in events.filter (pk__in = pks[i:i + DUMP_CHUNK_SIZE]):
+            yield make (it)
+
+def fair_stream (fair, dump, pretty = True, fmt = 'xml'):
     events = FairEvent.objects.filter (fair = fair)
     events = events.filter (status = Record.ACTIVE)
     events = events.order_by ('organisationcontact__line1')
     events = events.order_by ('time')
 
-    impl = getDOMImplementation ()
-    doc = impl.createDocument (None, 'events', None)
-    root = doc.documentElement
-    root.setAttribute ('year', str (fair.date.year))
-    root.setAttribute ('month', str (fair.date.month))
-    root.setAttribute ('day', str (fair.date.day))
+    if fmt == 'json':
+        make_full, make_id = event_dict, event_id_dict
+    else:
+        make_full, make_id = make_event_ele, make_event_id_ele
 
     if dump:
-        for it in events:
-            ele = doc.createElement ('event')
-            root.appendChild (ele)
-            populate_event_ele (doc, ele, it)
+        children = iterate_dump_events (events, make_full)
     else:
-        for it in events:
-            add_event_id_ele (doc, root, 'event', it)
-
-    return HttpResponse (doc.toprettyxml ('  ', '\n', 'utf-8'),
-                         mimetype = 'application/xml')
-
-def event_obj (event):
-    impl = getDOMImplementation ()
-    doc = impl.createDocument (None, 'event', None)
-    ele = doc.documentElement
-    populate_event_ele (doc, ele, event)
-    return HttpResponse (doc.toprettyxml ('  ', '\n', 'utf-8'),
-                         mimetype = 'application/xml')
+        children = (make_id (it) for it in events.iterator ())
+
+    if fmt == 'json':
+        return stream_json (date_dict (fair.date), 'events', children)
+    return stream_document (make_fair_root (fair), children, pretty)
+
+def fair_obj (fair, dump, pretty = True, fmt = 'xml'):
+    return stream_response (fair_stream (fair, dump, pretty, fmt), fmt)
+
+def get_request_version (request, fair):
+    # normally already looked up for the conditional GET
+    version = getattr (request, '_prog_version', None)
+    if version is None or version.fair_id != fair.pk:
+        version = FairDataVersion.get_for_fair (pk = fair.pk)
+    return version
+
+def get_encoding (request):
+    # Preferred encoding of the snapshot files accepted by the client, or
+    # None to send them uncompressed.
+    accepted = {}
+    for it in request.META.get ('HTTP_ACCEPT_ENCODING', '').split (','):
+        params = it.split (';')
+        q = 1.0
+        for p in params[1:]:
+            name, sep, value = p.partition ('=')
+            if name.strip () == 'q':
+                try:
+                    q = float (value)
+                except ValueError:
+                    q = 0.0
+        accepted[params[0].strip ().lower ()] = q
+
+    for encoding, ext in snapshot.ENCODINGS:
+        if accepted.get (encoding, accepted.get ('*', 0.0)) > 0.0:
+            return encoding
+
+    return None
+
+def fair_snapshot (request, fair, dump):
+    fmt = get_fmt (request)
+    encoding = get_encoding (request)
+    version = get_request_version (request, fair)
+    f = snapshot.open_file (fair, version, dump, get_pretty (request), fmt,
+                            encoding)
+    resp = stream_response (FileWrapper (f), fmt)
+    resp['Content-Length'] = str (os.fstat (f.fileno ()).st_size)
+    if encoding is not None:
+        resp['Content-Encoding'] = encoding
+    patch_vary_headers (resp, ['Accept-Encoding'])
+    return resp
+
+def event_obj (event, pretty = True, fmt = 'xml'):
+    if fmt == 'json':
+        return HttpResponse (to_json (event_dict (event)),
+                             mimetype = MIMETYPES[fmt])
+    ele = make_event_ele (event)
+    return stream_response (stream_document (ele, ele.children, pretty), fmt)
 
 def get_list (request, param):
     if param in request.GET:
@@ -162,120 +347,247 @@ def get_pos_int (request, param):
     return val
 
 def search_obj (request, fair):
-    impl = getDOMImplementation ()
-    doc = impl.createDocument (None, 'events', None)
-    root = doc.documentElement
-    root.setAttribute ('year', str (fair.date.year))
-    root.setAttribute ('month', str (fair.date.month))
-    root.setAttribute ('day', str (fair.date.day))
-
     fe = FairEvent.objects.filter (fair = fair)
+    venue_words = get_list (request, 'venue')
+    desc_words = get_list (request, 'desc')
+
+    if venue_words or desc_words:
+        ranked_ids = fulltext.match (fair, desc_words, venue_words)
+    else:
+        ranked_ids = None
+
+    if ranked_ids is not None:
+        ids = set (ranked_ids)
+        venue_words = desc_words = []
+    else:
+        ids = None
 
-    for l in get_list (request, 'venue'):
+    for l in venue_words:
         fe = fe.filter (Q (event__location__icontains = l)
                         | Q (event__org__name__icontains = l))
 
+    # hour and age are looked up in the in-memory index of the fair
     hour = get_pos_int (request, 'hour')
-    if (hour >= 0) and (hour < 24):
-        time = datetime.time (hour)
-        fe = fe.filter ((Q (event__time__isnull = True)
-                         | Q (event__time__lte = time))
-                        & (Q (event__end_time__isnull = True)
-                           | Q (event__end_time__gte = time)))
-
     age = get_pos_int (request, 'age')
-    if age > 0:
-        fe = fe.filter ((Q (age_min__isnull = True)
-                         | Q (age_min__lte = age))
-                        & (Q (age_max__isnull = True)
-                           | Q (age_max__gte = age)))
+    if ((hour >= 0) and (hour < 24)) or (age > 0):
+        index = intervals.get_index (fair, get_request_version (request, fair))
+
+        if (hour >= 0) and (hour < 24):
+            running = index.running_at (datetime.time (hour))
+            ids = running if ids is None else ids & running
+
+        if age > 0:
+            suitable = index.suitable_for (age)
+            ids = suitable if ids is None else ids & suitable
+
+    if ids is not None:
+        fe = fe.filter (pk__in = list (ids))
 
     if 'cat' in request.GET:
         category = request.GET['cat']
         fe = fe.filter (categories__word__icontains = category)
 
-    for w in get_list (request, 'desc'):
+    for w in desc_words:
         fe = fe.filter (Q (event__name__icontains = w)
                         | Q (event__description__icontains = w)
                         | Q (event__org__name__icontains = w))
 
-    fe = fe.order_by ('event__name')
+    if ranked_ids is not None:
+        rank = dict ((pk, i) for i, pk in enumerate (ranked_ids))
+        events = sorted (fe, key = lambda e: rank[e.pk])
+    else:
+        events = fe.order_by ('event__name').iterator ()
+
+    return list_response (request, make_fair_root (fair),
+                          date_dict (fair.date), 'events', events,
+                          make_event_id_ele, event_id_dict)
+
+def make_removed_ele (main_id):
+    ele = Element ('removed')
+    ele.set ('id', str (main_id))
+    return ele
+
+def changes_obj (request, fair):
+    # Events changed since the given version, or all of them if not provided,
+    # and the ids of the ones which have been removed from the programme.
+    fmt = get_fmt (request)
+    since = get_pos_int (request, 'since')
+    version = get_request_version (request, fair)
+    events = FairEvent.objects.filter (fair = fair)
+    events = events.filter (status = Record.ACTIVE)
+    events = events.order_by ('time')
+    removed = []
 
-    for it in fe:
-        add_event_id_ele (doc, root, 'event', it)
+    if version is None:
+        # the fair has just been deleted, so send everything
+        since = current = 0
+    else:
+        current = version.version
+
+    if since > 0:
+        changes = FairEventChange.objects.filter (fair = fair,
+                                                  version__gt = since)
+        changes = list (changes.values_list ('event_id', 'main_id'))
+        events = events.filter (pk__in = [it[0] for it in changes])
+        active = set (events.values_list ('pk', flat = True))
+        removed = [main_id for event_id, main_id in changes
+                   if event_id not in active]
+
+    if fmt == 'json':
+        root = date_dict (fair.date)
+        root.update ({'version': current, 'removed': removed})
+        stream = stream_json (root, 'events',
+                              iterate_dump_events (events, event_dict))
+    else:
+        root = make_fair_root (fair)
+        root.tag = 'changes'
+        root.set ('version', str (current))
+        children = chain (iterate_dump_events (events, make_event_ele),
+                          (make_removed_ele (it) for it in removed))
+        stream = stream_document (root, children, get_pretty (request))
 
-    return HttpResponse (doc.toprettyxml ('  ', '\n', 'utf-8'),
-                         mimetype = 'application/xml')
+    return stream_response (stream, fmt)
 
 def get_fair_event (request, fair, event_id):
     event = FairEvent.get_for_fair (event_id, fair)
     if not event:
         raise Http404
-    return event_obj (event)
+    return event_obj (event, get_pretty (request), get_fmt (request))
 
 # -----------------------------------------------------------------------------
+# conditional GET based on the programme data version
+
+def fair_version (request, fair_year = None, **kwargs):
+    if not hasattr (request, '_prog_version'):
+        if fair_year is None:
+            v = FairDataVersion.get_for_fair (current = True)
+        else:
+            v = FairDataVersion.get_for_fair (date__year = int (fair_year))
+        request._prog_version = v
+    return request._prog_version
+
+def global_version (request, *args, **kwargs):
+    if not hasattr (request, '_prog_version'):
+        request._prog_version = FairDataVersion.get_global ()
+    return request._prog_version
+
+def version_condition (get_version, encoded = False):
+    # With encoded, the response depends on the Accept-Encoding header so
+    # each encoding gets its own ETag and Vary is also set on the 304.
+    def etag (request, *args, **kwargs):
+        v = get_version (request, *args, **kwargs)
+        if v is None:
+            return None
+        encoding = get_encoding (request) if encoded else None
+        if encoding is None:
+            return v.etag
+        return '{0}-{1}'.format (v.etag, encoding)
+
+    def last_modified (request, *args, **kwargs):
+        # condition expects UTC but the versions use the local time
+        v = get_version (request, *args, **kwargs)
+        if v is None:
+            return None
+        return datetime.datetime.utcfromtimestamp (
+            time.mktime (v.modified.timetuple ()))
+
+    cond = condition (etag_func = etag, last_modified_func = last_modified)
+    if not encoded:
+        return cond
+
+    def decorator (func):
+        view = cond (func)
+        @wraps (func)
+        def wrapper (request, *args, **kwargs):
+            resp = view (request, *args, **kwargs)
+            patch_vary_headers (resp, ['Accept-Encoding'])
+            return resp
+        return wrapper
+    return decorator
+
+fair_condition = version_condition (fair_version)
+snapshot_condition = version_condition (fair_version, encoded = True)
+global_condition = version_condition (global_version)
 
-def all_fairs (request):
-    impl = getDOMImplementation ()
-    doc = impl.createDocument (None, 'fairs', None)
-    root = doc.documentElement
-    root.setAttribute ("api_version", "1.2")
+# -----------------------------------------------------------------------------
 
-    for fair in Fair.objects.all ():
-        ele = doc.createElement ('fair')
-        root.appendChild (ele)
+def make_fair_ele (fair):
+    ele = Element ('fair')
 
-        if fair.current:
-            ele.setAttribute ('current', 'True')
+    if fair.current:
+        ele.set ('current', 'True')
 
-        add_date_ele (doc, ele, 'date', fair.date)
+    add_date_ele (ele, 'date', fair.date)
+    return ele
 
-    return HttpResponse (doc.toprettyxml ('  ', '\n', 'utf-8'),
-                         mimetype = 'application/xml')
+@global_condition
+def all_fairs (request):
+    root = Element ('fairs')
+    root.set ("api_version", "1.2")
+    return list_response (request, root, {'api_version': '1.2'}, 'fairs',
+                          Fair.objects.all (), make_fair_ele, fair_dict)
 
+@snapshot_condition
 def fair (request, fair_year):
-    return fair_obj (get_object_or_404 (Fair, date__year = int (fair_year)),
-                     False)
+    fair = get_object_or_404 (Fair, date__year = int (fair_year))
+    return fair_snapshot (request, fair, False)
 
+@snapshot_condition
 def current (request):
-    return fair_obj (get_object_or_404 (Fair, current = True), False)
+    return fair_snapshot (request, get_object_or_404 (Fair, current = True),
+                          False)
 
+@fair_condition
 def event (request, fair_year, event_id):
     fair = get_object_or_404 (Fair, date__year = fair_year)
     return get_fair_event (request, fair, event_id)
 
+@fair_condition
 def current_event (request, event_id):
     return get_fair_event (request, Fair.get_current (), event_id)
 
+@fair_condition
+def changes (request, fair_year):
+    fair = get_object_or_404 (Fair, date__year = int (fair_year))
+    return changes_obj (request, fair)
+
+@fair_condition
+def current_changes (request):
+    return changes_obj (request, get_object_or_404 (Fair, current = True))
+
+@snapshot_condition
 def dump (request, fair_year):
-    return fair_obj (get_object_or_404 (Fair, date__year = int (fair_year)),
-                     True)
+    fair = get_object_or_404 (Fair, date__year = int (fair_year))
+    return fair_snapshot (request, fair, True)
 
+@snapshot_condition
 def current_dump (request):
-    return fair_obj (get_object_or_404 (Fair, current = True), True)
+    return fair_snapshot (request, get_object_or_404 (Fair, current = True),
+                          True)
+
+def make_cat_ele (cat):
+    ele = Element ('category')
+    ele.set ('id', str (cat.pk))
+    ele.set ('name', cat.word)
+    return ele
 
+@global_condition
 def cats (request, fair_year):
     # ToDo: review names of categories, types etc.
-    impl = getDOMImplementation ()
-    doc = impl.createDocument (None, 'categories', None)
-    root = doc.documentElement
-
-    for it in FairEventCategory.objects.all ():
-        ele = doc.createElement ('category')
-        root.appendChild (ele)
-        ele.setAttribute ('id', str (it.pk))
-        ele.setAttribute ('name', it.word)
-
-    return HttpResponse (doc.toprettyxml ('  ', '\n', 'utf-8'),
-                         mimetype = 'application/xml')
+    return list_response (request, Element ('categories'), {}, 'categories',
+                          FairEventCategory.objects.all (),
+                          make_cat_ele, cat_dict)
 
+@global_condition
 def current_cats (request):
     return cats (request, None) # placeholder until types are fair-related
 
+@fair_condition
 def search (request, fair_year):
     fair = get_object_or_404 (Fair, date__year = fair_year)
     return search_obj (request, fair)
 
+@fair_condition
 def current_search (request):
     fair = get_object_or_404 (Fair, current = True)
     return search_obj (request, fair)
@@ -0,0 +1,219 @@
+# MRWF - extra/public/snapshot.py
+#
+# Copyright (C) 2009, 2010, 2011. 2012, 2013
+# Guillaume Tucker <guillaume@mangoz.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Programme files kept under CACHE_PATH for each fair data version, with
+# their compressed copies.
+
+import os
+import re
+import gzip
+import shutil
+import logging
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connection
+from cams.models import Fair
+from mrwf.extra.models import FairDataVersion, prog_changed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+REBUILD_DELAY = 2.0
+
+# Content-Encoding name and file name extension, in order of preference
+ENCODINGS = [('gzip', '.gz')]
+if brotli is not None:
+    ENCODINGS.insert(0, ('br', '.br'))
+EXTENSIONS = dict(ENCODINGS)
+
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def get_dir(fair_id):
+    return os.path.join(settings.CACHE_PATH, 'prog', str(fair_id))
+
+
+def get_name(dump, pretty, fmt):
+    name = 'dump' if dump else 'list'
+    if fmt == 'xml' and not pretty:
+        name += '-compact'
+    return name
+
+
+def get_path(version, dump, pretty, fmt, encoding=None):
+    file_name = '{0}-{1}.{2}'.format(get_name(dump, pretty, fmt),
+                                     version.version, fmt)
+    if encoding is not None:
+        file_name += EXTENSIONS[encoding]
+    return os.path.join(get_dir(version.fair_id), file_name)
+
+
+def get_tmp_path(path):
+    return '{0}.{1}-{2}.tmp'.format(path, os.getpid(),
+                                    threading.current_thread().ident)
+
+
+def get_lock_path(fair_id, dump, pretty, fmt):
+    file_name = '{0}.{1}.lock'.format(get_name(dump, pretty, fmt), fmt)
+    return os.path.join(get_dir(fair_id), file_name)
+
+
+@contextmanager
+def locked(lock_path):
+    # flock locks belong to the open file, so this also works between the
+    # threads of a process.  Without fcntl, files may be built concurrently
+    # which is wasteful but still safe as they are renamed into place.
+    if fcntl is None:
+        yield
+        return
+    with open(lock_path, 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def make_dirs(path):
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def purge(version, dump, pretty, fmt):
+    """Remove the files of the older versions."""
+    name_re = re.compile(r'^{0}-(\d+)\.{1}(\.gz|\.br)?$'.format(
+            get_name(dump, pretty, fmt), fmt))
+    dir_path = get_dir(version.fair_id)
+    for file_name in os.listdir(dir_path):
+        m = name_re.match(file_name)
+        if m and int(m.group(1)) < version.version:
+            try:
+                os.remove(os.path.join(dir_path, file_name))
+            except OSError:
+                pass
+
+
+def compress(path, encoding):
+    """Write the compressed copy of a file."""
+    out_path = path + EXTENSIONS[encoding]
+    tmp_path = get_tmp_path(out_path)
+    with open(path, 'rb') as f_in, open(tmp_path, 'wb') as f_out:
+        if encoding == 'br':
+            f_out.write(brotli.compress(f_in.read()))
+        else:
+            # fixed mtime so the output only depends on the contents
+            gz = gzip.GzipFile('', 'wb', 9, f_out, 0)
+            shutil.copyfileobj(f_in, gz)
+            gz.close()
+    os.rename(tmp_path, out_path)
+    return out_path
+
+
+def build(fair, version, dump, pretty, fmt):
+    from mrwf.extra.public.prog import fair_stream
+    path = get_path(version, dump, pretty, fmt)
+    make_dirs(os.path.dirname(path))
+    tmp_path = get_tmp_path(path)
+    with open(tmp_path, 'wb') as f:
+        for chunk in fair_stream(fair, dump, pretty, fmt):
+            f.write(chunk)
+    os.rename(tmp_path, path)
+    for encoding, ext in ENCODINGS:
+        compress(path, encoding)
+    purge(version, dump, pretty, fmt)
+    return path
+
+
+def make(fair, version, dump, pretty, fmt, encoding):
+    # to be called with the lock held
+    path = get_path(version, dump, pretty, fmt, encoding)
+    # it may have been built while waiting for the lock
+    if not os.path.exists(path):
+        plain_path = get_path(version, dump, pretty, fmt)
+        if not os.path.exists(plain_path):
+            build(fair, version, dump, pretty, fmt)
+        else:
+            compress(plain_path, encoding)
+    return path
+
+
+def get(fair, version, dump, pretty=True, fmt='xml', encoding=None):
+    """Get the path to the serialized programme, building it if needed.
+
+    With an encoding, the path to the compressed copy is returned.
+    """
+    path = get_path(version, dump, pretty, fmt, encoding)
+    if os.path.exists(path):
+        return path
+
+    make_dirs(get_dir(version.fair_id))
+    with locked(get_lock_path(version.fair_id, dump, pretty, fmt)):
+        return make(fair, version, dump, pretty, fmt, encoding)
+
+
+def open_file(fair, version, dump, pretty=True, fmt='xml', encoding=None):
+    """Open the serialized programme like get() returns its path."""
+    try:
+        return open(get_path(version, dump, pretty, fmt, encoding), 'rb')
+    except IOError:
+        pass
+
+    # opened with the lock held so it can't be purged in the meantime
+    make_dirs(get_dir(version.fair_id))
+    with locked(get_lock_path(version.fair_id, dump, pretty, fmt)):
+        return open(make(fair, version, dump, pretty, fmt, encoding), 'rb')
+
+
+def rebuild():
+    with _pending_lock:
+        fair_ids = list(_pending)
+        _pending.clear()
+
+    try:
+        for fair in Fair.objects.filter(pk__in=fair_ids):
+            version = FairDataVersion.get_for_fair(pk=fair.pk)
+            for dump in [True, False]:
+                for fmt in ['xml', 'json']:
+                    get(fair, version, dump, fmt=fmt)
+    except Exception:
+        logging.getLogger('cams').exception('programme snapshot rebuild')
+    finally:
+        connection.close()
+
+
+def schedule_rebuild(sender, fair_ids, **kwargs):
+    with _pending_lock:
+        start = not _pending
+        _pending.update(fair_ids)
+
+    if start:
+        t = threading.Timer(REBUILD_DELAY, rebuild)
+        t.daemon = True
+        t.start()
+
+prog_changed.connect(schedule_rebuild)
@@ -25,11 +25,13 @@ urlpatterns = patterns('mrwf.extra.public',
  (r'prog/current/$', 'prog.current'),
  (r'prog/current/(?P<event_id>\d+)/$', 'prog.current_event'),
  (r'prog/current/dump/$', 'prog.current_dump'),
+ (r'prog/current/changes$', 'prog.current_changes'),
  (r'prog/current/categories/$', 'prog.current_cats'),
  (r'prog/current/search$', 'prog.current_search'),
  (r'prog/(?P<fair_year>\d+)/$', 'prog.fair'),
  (r'prog/(?P<fair_year>\d+)/(?P<event_id>\d+)/$', 'prog.event'),
  (r'prog/(?P<fair_year>\d+)/dump/$', 'prog.dump'),
+ (r'prog/(?P<fair_year>\d+)/changes$', 'prog.changes'),
  (r'prog/(?P<fair_year>\d+)/categories/$', 'prog.cats'),
  (r'prog/(?P<fair_year>\d+)/search$', 'prog.search'),
  (r'apply/$', 'apply.post'),
@@ -0,0 +1,113 @@
+# MRWF - extra/public/xmlstream.py
+#
+# Copyright (C) 2009, 2010, 2011. 2012, 2013
+# Guillaume Tucker <guillaume@mangoz.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Streaming replacement for the xml.dom.minidom documents used by the public
+# programme API.  The output is byte-identical to what minidom produces with
+# toprettyxml('  ', '\n', 'utf-8') (pretty) or toxml('utf-8') (compact), but
+# the top-level children are serialized one at a time as they are produced so
+# the whole document never needs to be held in memory.
+
+XML_HEADER = u'<?xml version="1.0" encoding="utf-8"?>'
+CHUNK_PARTS = 4096
+
+
+def escape(data):
+    # Same as xml.dom.minidom._write_data
+    return data.replace(u'&', u'&amp;').replace(u'<', u'&lt;'). \
+        replace(u'"', u'&quot;').replace(u'>', u'&gt;')
+
+
+class Element(object):
+    def __init__(self, tag):
+        self.tag = tag
+        self.attrs = {}
+        self.children = []
+        self.text = None
+
+    def set(self, name, value):
+        self.attrs[name] = value
+
+    def add(self, tag):
+        child = Element(tag)
+        self.children.append(child)
+        return child
+
+    def write_open(self, out, indent):
+        out.append(indent)
+        out.append(u'<')
+        out.append(self.tag)
+        for name in sorted(self.attrs.keys()):
+            out.append(u' {0}="'.format(name))
+            out.append(escape(self.attrs[name]))
+            out.append(u'"')
+
+    def write(self, out, indent, addindent, newl):
+        self.write_open(out, indent)
+        if self.text is not None:
+            out.append(u'>')
+            out.append(escape(self.text))
+            out.append(u'</{0}>{1}'.format(self.tag, newl))
+        elif self.children:
+            out.append(u'>')
+            out.append(newl)
+            for child in self.children:
+                child.write(out, indent + addindent, addindent, newl)
+            out.append(u'{0}</{1}>{2}'.format(indent, self.tag, newl))
+        else:
+            out.append(u'/>')
+            out.append(newl)
+
+
+def stream_document(root, children, pretty=True):
+    """Generate a UTF-8 encoded XML document in chunks.
+
+    The root element attributes are taken from root and its children are
+    consumed lazily from the children iterable.
+    """
+    if pretty:
+        addindent = u'  '
+        newl = u'\n'
+    else:
+        addindent = u''
+        newl = u''
+
+    out = [XML_HEADER, newl]
+    root.write_open(out, u'')
+    has_children = False
+
+    for child in children:
+        if not has_children:
+            out.append(u'>')
+            out.append(newl)
+            has_children = True
+        child.write(out, addindent, addindent, newl)
+        if len(out) >= CHUNK_PARTS:
+            yield u''.join(out).encode('utf-8')
+            out = []
+
+    if has_children:
+        out.append(u'</{0}>{1}'.format(root.tag, newl))
+    else:
+        out.append(u'/>')
+        out.append(newl)
+
+    yield u''.join(out).encode('utf-8')
+
+
+def render_document(root, pretty=True):
+    return ''.join(stream_document(root, root.children, pretty))
@@ -0,0 +1,151 @@
+# MRWF - extra/search.py
+#
+# Copyright (C) 2009, 2010, 2011. 2012, 2013
+# Guillaume Tucker <guillaume@mangoz.org>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Full-text index of the fair events, using SQLite FTS5 when available.
+
+from django.db import connection, transaction, DatabaseError
+from django.db.models.signals import post_save, post_delete, post_syncdb
+from cams.models import Organisation
+from mrwf.extra.models import FairEvent, StallEvent
+
+TABLE = 'extra_faireventsearch'
+DESC_COLUMNS = ['name', 'description', 'org_name']
+VENUE_COLUMNS = ['location', 'org_name']
+
+_available = None
+
+
+def is_available():
+    global _available
+    if _available is None:
+        if connection.vendor != 'sqlite':
+            _available = False
+        else:
+            cursor = connection.cursor()
+            cursor.execute("SELECT COUNT(*) FROM sqlite_master "
+                           "WHERE type='table' AND name=%s", [TABLE])
+            _available = bool(cursor.fetchone()[0])
+    return _available
+
+
+def _event_row(event):
+    if event.org_id:
+        org_name = event.org.name
+    else:
+        org_name = ''
+    return [event.pk, event.fair_id, event.name, event.description or '',
+            org_name, event.location or '']
+
+
+def _write_rows(rows):
+    cursor = connection.cursor()
+    cursor.executemany("INSERT OR REPLACE INTO {0} (rowid, fair_id, name, "
+                       "description, org_name, location) "
+                       "VALUES (%s, %s, %s, %s, %s, %s)".format(TABLE), rows)
+    transaction.commit_unless_managed()
+
+
+def _delete_rows(event_ids):
+    cursor = connection.cursor()
+    cursor.executemany("DELETE FROM {0} WHERE rowid = %s".format(TABLE),
+                       [[pk] for pk in event_ids])
+    transaction.commit_unless_managed()
+
+
+def index_events(events):
+    if is_available():
+        _write_rows([_event_row(e) for e in events.select_related('org')])
+
+
+def rebuild():
+    if is_available():
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM {0}".format(TABLE))
+        index_events(FairEvent.objects.all())
+
+
+def _term(word):
+    return u'"{0}"*'.format(word.replace(u'"', u'""'))
+
+
+def match(fair, desc_words, venue_words):
+    """Search the events of a fair with the full-text index.
+
+    All the desc_words need to match the name, description or organisation
+    name, and all the venue_words the location or organisation name.  The
+    list of matching event ids is returned ordered by relevance, or None if
+    the index is not available.
+    """
+    if not is_available():
+        return None
+
+    terms = []
+    for words, columns in [(desc_words, DESC_COLUMNS),
+                           (venue_words, VENUE_COLUMNS)]:
+        for w in words:
+            terms.append(u'{{{0}}} : {1}'.format(' '.join(columns), _term(w)))
+
+    cursor = connection.cursor()
+    cursor.execute("SELECT rowid FROM {0} WHERE {0} MATCH %s "
+                   "AND fair_id = %s ORDER BY rank".format(TABLE),
+                   [u' AND '.join(terms), fair.pk])
+    return [row[0] for row in cursor.fetchall()]
+
+# -----------------------------------------------------------------------------
+# signal handlers
+
+def create_index(sender, **kwargs):
+    global _available
+    if connection.vendor != 'sqlite' or _available:
+        return
+    cursor = connection.cursor()
+    cursor.execute("SELECT COUNT(*) FROM sqlite_master "
+                   "WHERE type='table' AND name=%s", [TABLE])
+    if cursor.fetchone()[0]:
+        return
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE {0} USING fts5("
+                       "fair_id UNINDEXED, name, description, org_name, "
+                       "location, tokenize='unicode61 remove_diacritics 1')"
+                       .format(TABLE))
+    except DatabaseError:
+        # SQLite built without FTS5
+        return
+    transaction.commit_unless_managed()
+    _available = True
+    rebuild()
+
+
+def index_event(sender, instance, **kwargs):
+    if is_available():
+        _write_rows([_event_row(instance)])
+
+
+def unindex_event(sender, instance, **kwargs):
+    if is_available():
+        _delete_rows([instance.pk])
+
+
+def index_org_events(sender, instance, **kwargs):
+    index_events(FairEvent.objects.filter(org=instance.pk))
+
+for model in [FairEvent, StallEvent]:
+    post_save.connect(index_event, sender=model)
+    post_delete.connect(unindex_event, sender=model)
+post_save.connect(index_org_events, sender=Organisation)
+post_syncdb.connect(create_index)
@@ -5,7 +5,35 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
+import datetime
+import json
+import gzip
+import csv
+import os
+import shutil
+import tempfile
+import threading
+import time
+from StringIO import StringIO
+from django.db import connection
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.utils.functional import empty
+from django.utils.http import http_date
+from django.db.models import Q
 from django.test import TestCase
+from django.test.utils import override_settings
+from cams.models import Record, Person, Organisation, Contact, Fair
+from mrwf.extra.models import (FairEvent, FairEventCategory, StallEvent,
+                               ExportJob, FairDataVersion, FairEventChange,
+                               prog_changed)
+from mrwf.extra import jobs, imaging, eventimages
+from mrwf.extra.public import prog, intervals, snapshot
+from mrwf.extra.views import export, pdfexport
+
+# The snapshots are rebuilt in a thread with its own database connection,
+# which can't see the test database
+prog_changed.disconnect(snapshot.schedule_rebuild)
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,10 +42,597 @@ class SimpleTest(TestCase):
         """
         self.failUnlessEqual(1 + 1, 2)
 
+
+class CountQueries(object):
+    def __enter__(self):
+        self.old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        self.start = len(connection.queries)
+        return self
+
+    def __exit__(self, *args):
+        connection.use_debug_cursor = self.old_debug_cursor
+
+    @property
+    def count(self):
+        return len(connection.queries) - self.start
+
+
+class FairTestCase(TestCase):
+    def setUp(self):
+        self.fair = Fair.objects.create(date=datetime.date(2013, 12, 7),
+                                        current=True)
+        self.owner = Person.objects.create(first_name='Arthur',
+                                           last_name='Dent')
+        self.cats = [FairEventCategory.objects.create(word=w)
+                     for w in ['Music', 'Food', 'Kids']]
+
+    def add_events(self, n):
+        for i in range(n):
+            org = Organisation.objects.create(name='Org {0}'.format(i))
+            Contact.objects.create(obj=org, line_1='{0} Mill Road'.format(i),
+                                   town='Cambridge')
+            e = FairEvent.objects.create(name='Event {0}'.format(i),
+                                         status=Record.ACTIVE,
+                                         owner=self.owner, org=org,
+                                         fair=self.fair)
+            e.categories.add(*self.cats[:(i % len(self.cats)) + 1])
+
+
+class MediaTestCase(FairTestCase):
+    """Test case with MEDIA_ROOT and CACHE_PATH in a temporary directory."""
+
+    def setUp(self):
+        super(MediaTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.tmp_settings = override_settings(
+            MEDIA_ROOT=os.path.join(self.tmp_dir, 'media'),
+            CACHE_PATH=os.path.join(self.tmp_dir, 'cache'))
+        self.tmp_settings.enable()
+        # make the storage again with the new MEDIA_ROOT
+        default_storage._wrapped = empty
+
+    def tearDown(self):
+        self.tmp_settings.disable()
+        default_storage._wrapped = empty
+        shutil.rmtree(self.tmp_dir)
+
+    def add_image(self, event, name, size):
+        import Image
+        path = default_storage.path(name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        Image.new('RGB', size).save(path, 'PNG')
+        FairEvent.objects.filter(pk=event.pk).update(image=name,
+                                                     image_ready=True)
+
+
+class PublicProgTest(MediaTestCase):
+    MAX_DUMP_QUERIES = 5
+
+    def dump(self):
+        with CountQueries() as q:
+            xml = ''.join(prog.fair_obj(self.fair, True))
+        return xml, q.count
+
+    def test_dump_queries(self):
+        self.add_events(2)
+        xml, n_small = self.dump()
+        self.assertEqual(xml.count('<event '), 2)
+        self.add_events(20)
+        xml, n_large = self.dump()
+        self.assertEqual(xml.count('<event '), 22)
+        self.assertEqual(xml.count('line_1="7 Mill Road"'), 1)
+        self.assertTrue(n_large <= self.MAX_DUMP_QUERIES)
+        self.assertEqual(n_small, n_large)
+
+    def test_dump_chunks(self):
+        self.add_events(7)
+        lines = sorted(self.dump()[0].splitlines())
+        chunk_size = prog.DUMP_CHUNK_SIZE
+        prog.DUMP_CHUNK_SIZE = 3
+        try:
+            self.assertEqual(sorted(self.dump()[0].splitlines()), lines)
+        finally:
+            prog.DUMP_CHUNK_SIZE = chunk_size
+
+    def test_not_modified(self):
+        url = '/public/prog/current/dump/'
+        self.add_events(2)
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        etag = resp['ETag']
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+        e = FairEvent.objects.filter(fair=self.fair)[0]
+        e.description = 'Changed'
+        e.save()
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp['ETag'], etag)
+
+    def test_last_modified(self):
+        self.add_events(2)
+        self.assertEqual(
+            FairDataVersion.objects.filter(fair__isnull=True).count(), 1)
+        resp = self.client.get('/public/prog/current/dump/')
+        modified = FairDataVersion.get_for_fair(pk=self.fair.pk).modified
+        self.assertEqual(resp['Last-Modified'], http_date(
+                time.mktime(modified.timetuple())))
+
+    def test_json_dump(self):
+        self.add_events(3)
+        resp = self.client.get('/public/prog/current/dump/', {'fmt': 'json'})
+        self.assertEqual(resp['Content-Type'], 'application/json')
+        prog_json = json.loads(''.join(resp))
+        self.assertEqual(prog_json['year'], 2013)
+        self.assertEqual(len(prog_json['events']), 3)
+        for e in prog_json['events']:
+            self.assertEqual(e['address']['town'], 'Cambridge')
+
+    def test_composite_contact(self):
+        self.add_events(1)
+        e = FairEvent.objects.get(name='Event 0')
+        self.assertEqual(e.get_composite_contact().line_1, '0 Mill Road')
+        c = Contact.objects.get(obj=e.org)
+        c.line_1 = '1 Mill Road'
+        c.save()
+        e = FairEvent.objects.get(pk=e.pk)
+        self.assertEqual(e.get_composite_contact().line_1, '1 Mill Road')
+        e.line_1 = '2 Mill Road'
+        e.save()
+        e = FairEvent.objects.get(pk=e.pk)
+        self.assertEqual(e.get_composite_contact().line_1, '2 Mill Road')
+        self.assertEqual(e.get_composite_contact().town, 'Cambridge')
+
+    def test_composite_contacts(self):
+        self.add_events(5)
+        events = list(FairEvent.objects.filter(fair=self.fair))
+        with CountQueries() as q:
+            contacts = FairEvent.get_composite_contacts(events)
+        self.assertEqual(q.count, 1)
+        for e in events:
+            c = contacts[e.pk]
+            self.assertEqual(c.line_1, e.get_composite_contact().line_1)
+            self.assertEqual(c.town, 'Cambridge')
+
+    def test_programme_csv(self):
+        def get_csv():
+            events = FairEvent.objects.filter(fair=self.fair)
+            with CountQueries() as q:
+                data = ''.join(export.iterate_programme_csv(events))
+            rows = list(csv.reader(StringIO(data)))
+            return rows, q.count
+
+        self.add_events(2)
+        rows, n_small = get_csv()
+        self.assertEqual(tuple(rows[0]), export.PROGRAMME_COLUMNS)
+        self.add_events(20)
+        rows, n_large = get_csv()
+        self.assertEqual(len(rows), 23)
+        self.assertEqual(n_small, n_large)
+        names = [dict(zip(rows[0], row))['organisation'] for row in rows[1:]]
+        self.assertTrue('Org 7' in names)
+
+    def test_subtype(self):
+        self.add_events(1)
+        stall = StallEvent.objects.create(name='Stall', owner=self.owner,
+                                          fair=self.fair)
+        self.assertEqual(stall.subtype, FairEvent.STALL)
+        e = FairEvent.objects.get(pk=stall.pk)
+        e.save()
+        e = FairEvent.objects.get(pk=stall.pk)
+        self.assertEqual(e.subtype, FairEvent.STALL)
+        e = FairEvent.objects.get(name='Event 0')
+        self.assertEqual(e.subtype, FairEvent.BASIC)
+
+    def test_delete_fair(self):
+        self.add_events(3)
+        fair_id = self.fair.pk
+        self.assertEqual(FairEventChange.objects.filter(fair=fair_id).count(),
+                         3)
+        self.fair.delete()
+        self.assertFalse(FairEvent.objects.filter(fair=fair_id).exists())
+        self.assertFalse(
+            FairDataVersion.objects.filter(fair=fair_id).exists())
+        self.assertFalse(
+            FairEventChange.objects.filter(fair=fair_id).exists())
+
+    def test_gzip_dump(self):
+        url = '/public/prog/current/dump/'
+        self.add_events(3)
+        plain = ''.join(self.client.get(url))
+        resp = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(resp['Content-Encoding'], 'gzip')
+        self.assertTrue('Accept-Encoding' in resp['Vary'])
+        data = ''.join(resp)
+        self.assertEqual(int(resp['Content-Length']), len(data))
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(data)).read(), plain)
+        resp = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertFalse(resp.has_header('Content-Encoding'))
+
+    def test_encoded_etag(self):
+        url = '/public/prog/current/dump/'
+        self.add_events(2)
+        plain = self.client.get(url)
+        resp = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotEqual(resp['ETag'], plain['ETag'])
+        resp = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip',
+                               HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(resp.status_code, 304)
+        self.assertTrue('Accept-Encoding' in resp['Vary'])
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(resp.status_code, 200)
+
+    def test_search(self):
+        self.add_events(3)
+        e = FairEvent.objects.get(name='Event 1')
+        e.description = 'Jazz band playing jazz'
+        e.save()
+        e = FairEvent.objects.get(name='Event 2')
+        e.description = 'Jazzy cakes'
+        e.save()
+        resp = self.client.get('/public/prog/current/search',
+                               {'desc': 'jazz', 'fmt': 'json'})
+        events = json.loads(''.join(resp))['events']
+        self.assertEqual([e['name'] for e in events], ['Event 1', 'Event 2'])
+        resp = self.client.get('/public/prog/current/search',
+                               {'desc': 'jazz', 'venue': 'org 2',
+                                'fmt': 'json'})
+        events = json.loads(''.join(resp))['events']
+        self.assertEqual([e['name'] for e in events], ['Event 2'])
+
+    def test_changes(self):
+        url = '/public/prog/current/changes'
+        self.add_events(4)
+        resp = self.client.get(url, {'fmt': 'json'})
+        changes = json.loads(''.join(resp))
+        self.assertEqual(len(changes['events']), 4)
+        self.assertEqual(changes['removed'], [])
+        since = changes['version']
+
+        edited = FairEvent.objects.get(name='Event 0')
+        edited.description = 'New description'
+        edited.save()
+        disabled = FairEvent.objects.get(name='Event 1')
+        disabled.status = Record.DISABLED
+        disabled.save()
+        deleted = FairEvent.objects.get(name='Event 2')
+        deleted_id = deleted.main_id
+        deleted.delete()
+
+        resp = self.client.get(url, {'fmt': 'json', 'since': since})
+        changes = json.loads(''.join(resp))
+        self.assertTrue(changes['version'] > since)
+        self.assertEqual([e['name'] for e in changes['events']], ['Event 0'])
+        self.assertEqual(sorted(changes['removed']),
+                         sorted([disabled.main_id, deleted_id]))
+
+    def test_fair_date_changes(self):
+        url = '/public/prog/current/changes'
+        self.add_events(2)
+        since = FairDataVersion.get_for_fair(pk=self.fair.pk).version
+        self.fair.date = datetime.date(2014, 12, 6)
+        self.fair.save()
+        resp = self.client.get(url, {'fmt': 'json', 'since': since})
+        changes = json.loads(''.join(resp))
+        self.assertEqual(changes['year'], 2014)
+        self.assertEqual(len(changes['events']), 2)
+
+
+class ExportJobTest(MediaTestCase):
+    def test_export_job(self):
+        self.add_events(3)
+        params = {'listing': -1, 'fmt': 'csv'}
+        job = jobs.submit('programme', params, 'Programme.csv', 'text/csv')
+        self.assertEqual(job.status, ExportJob.PENDING)
+        self.assertEqual(jobs.claim().pk, job.pk)
+        self.assertEqual(jobs.claim(), None)
+        self.assertTrue(jobs.run(job))
+        job = ExportJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, ExportJob.DONE)
+        with open(jobs.get_path(job), 'rb') as f:
+            self.assertEqual(len(list(csv.reader(f))), 4)
+        same = jobs.submit('programme', params, 'Programme.csv', 'text/csv')
+        self.assertEqual(same.pk, job.pk)
+        self.add_events(1)
+        new = jobs.submit('programme', params, 'Programme.csv', 'text/csv')
+        self.assertNotEqual(new.pk, job.pk)
+
+    def test_stale_task(self):
+        job = jobs.submit_task(eventimages.JOB_NAME,
+                               {'event_id': 0, 'name': 'x.png'})
+        self.assertEqual(jobs.claim().pk, job.pk)
+        self.assertEqual(jobs.claim(), None)
+        # the worker has crashed while running the task
+        started = datetime.datetime.now() - jobs.STALE_DELAY * 2
+        ExportJob.objects.filter(pk=job.pk).update(started=started)
+        self.assertEqual(jobs.claim().pk, job.pk)
+
+
+class ImagingTest(TestCase):
+    def test_image_derivatives(self):
+        import Image
+        root = tempfile.mkdtemp()
+        try:
+            src = os.path.join(root, 'src.png')
+            Image.new('RGB', (1000, 500)).save(src, 'PNG')
+            derived = imaging.make_derivatives(src, 'abc', root, 'derived',
+                                               [120, 800, 2000], ['JPEG'])
+            self.assertEqual([(d.width, d.height) for d in derived],
+                             [(120, 60), (800, 400), (1000, 500)])
+            for d in derived:
+                self.assertEqual(d.mimetype, 'image/jpeg')
+                img = Image.open(os.path.join(root, d.name))
+                self.assertEqual(img.size, (d.width, d.height))
+        finally:
+            shutil.rmtree(root)
+
+    def test_reduce_size(self):
+        import Image
+        root = tempfile.mkdtemp()
+        try:
+            path = os.path.join(root, 'big.jpeg')
+            Image.new('RGB', (3000, 2000), (200, 10, 10)).save(path, 'JPEG')
+            img = imaging.reduce_size(Image.open(path), (300, 200))
+            self.assertEqual(img.size, (300, 200))
+            self.assertTrue(img.getpixel((150, 100))[0] > 150)
+        finally:
+            shutil.rmtree(root)
+
+    def test_store_file(self):
+        root = tempfile.mkdtemp()
+        try:
+            info = imaging.ImageInfo(1, 1, 4, 'ab' * 20, 'PNG')
+            names = []
+            for i in range(2):
+                path = os.path.join(root, 'upload{0}.png'.format(i))
+                with open(path, 'wb') as f:
+                    f.write('data')
+                names.append(imaging.store_file(path, root, 'store', info))
+                self.assertFalse(os.path.exists(path))
+            self.assertEqual(names[0], names[1])
+            self.assertEqual(names[0], os.path.join('store', 'ab',
+                                                    'ab' * 20 + '.png'))
+            self.assertTrue(os.path.exists(os.path.join(root, names[0])))
+        finally:
+            shutil.rmtree(root)
+
+
+class EventImageTest(MediaTestCase):
+    def test_save_ready_image(self):
+        self.add_events(1)
+        e = FairEvent.objects.get(fair=self.fair)
+        self.add_image(e, 'img/ready.png', (100, 50))
+        e = FairEvent.objects.get(pk=e.pk)
+        mtime = os.path.getmtime(e.image.path)
+        e.description = 'Changed description'
+        e.save()
+        # the image has already been processed so it is left as it is
+        e = FairEvent.objects.get(pk=e.pk)
+        self.assertEqual(e.image.name, 'img/ready.png')
+        self.assertTrue(e.image_ready)
+        self.assertEqual(os.path.getmtime(e.image.path), mtime)
+        self.assertFalse(ExportJob.objects.exists())
+
+
+class ProcessImagesTest(MediaTestCase):
+    def process_images(self):
+        out = StringIO()
+        call_command('process_images', processes=1, stdout=out)
+        return out.getvalue()
+
+    def test_process_images(self):
+        self.add_events(2)
+        for i, e in enumerate(FairEvent.objects.filter(fair=self.fair)):
+            self.add_image(e, 'img/upload{0}.png'.format(i), (1600, 800))
+        # an image whose task has failed
+        FairEvent.objects.filter(pk=e.pk).update(image_ready=False)
+        self.assertTrue(self.process_images().startswith('2 events updated'))
+
+        names = set()
+        for e in FairEvent.objects.filter(fair=self.fair):
+            self.assertTrue(e.image.name.startswith('img/store/'))
+            self.assertEqual((e.image_width, e.image_height), (800, 400))
+            self.assertTrue(e.image_sizes.exists())
+            self.assertTrue(e.image_ready)
+            names.add(e.image.name)
+        # the two images were the same so they now share the stored file
+        self.assertEqual(len(names), 1)
+        self.assertTrue(default_storage.exists(names.pop()))
+        self.assertFalse(default_storage.exists('img/upload0.png'))
+        self.assertFalse(default_storage.exists('img/upload1.png'))
+
+        # nothing has changed since the last run
+        self.assertTrue(self.process_images().startswith('0 events updated'))
+
+
+class SnapshotTest(MediaTestCase):
+    def test_built_once(self):
+        self.add_events(2)
+        version = FairDataVersion.get_for_fair(pk=self.fair.pk)
+        built = []
+        build = snapshot.build
+
+        def counted_build(*args, **kwargs):
+            built.append(args)
+            return build(*args, **kwargs)
+
+        snapshot.build = counted_build
+        try:
+            path = snapshot.get(self.fair, version, True)
+            gz_path = snapshot.get(self.fair, version, True,
+                                   encoding='gzip')
+            self.assertEqual(snapshot.get(self.fair, version, True), path)
+        finally:
+            snapshot.build = build
+        self.assertEqual(len(built), 1)
+        with open(path, 'rb') as f:
+            self.assertEqual(gzip.open(gz_path).read(), f.read())
+
+    def test_locked(self):
+        if snapshot.fcntl is None:
+            return
+        lock_path = os.path.join(self.tmp_dir, 'test.lock')
+        active = []
+        overlaps = []
+
+        def hold_lock():
+            with snapshot.locked(lock_path):
+                active.append(1)
+                if len(active) > 1:
+                    overlaps.append(1)
+                time.sleep(0.02)
+                active.pop()
+
+        threads = [threading.Thread(target=hold_lock) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(overlaps, [])
+
+
+class ExportPublicTest(MediaTestCase):
+    def export(self):
+        out = StringIO()
+        call_command('export_public', os.path.join(self.tmp_dir, 'www'),
+                     stdout=out)
+        return out.getvalue()
+
+    def get_path(self, *args):
+        return os.path.join(self.tmp_dir, 'www', 'prog', *args)
+
+    def test_export_public(self):
+        self.add_events(2)
+        self.export()
+        self.assertEqual(os.readlink(self.get_path('current')), '2013')
+        for url_path in ['', '2013', '2013/dump', '2013/categories']:
+            for fmt in ['xml', 'json']:
+                path = self.get_path(url_path, 'index.' + fmt)
+                self.assertTrue(os.path.exists(path))
+                self.assertTrue(os.path.exists(path + '.gz'))
+        events = list(FairEvent.objects.filter(fair=self.fair))
+        for e in events:
+            path = self.get_path('2013', str(e.main_id), 'index.xml')
+            self.assertTrue(os.path.exists(path))
+
+        # only what has changed is written again
+        self.assertEqual(self.export(), "0 documents written\n")
+        events[0].description = 'Changed description'
+        events[0].save()
+        events[1].delete()
+        self.export()
+        path = self.get_path('2013', str(events[0].main_id), 'index.xml')
+        with open(path, 'rb') as f:
+            self.assertTrue('Changed description' in f.read())
+        self.assertFalse(os.path.exists(
+                self.get_path('2013', str(events[1].main_id))))
+
+
+class PdfExportTest(MediaTestCase):
+    def setUp(self):
+        super(PdfExportTest, self).setUp()
+        import Image
+        # small static images instead of the real ones
+        static_root = os.path.join(self.tmp_dir, 'static')
+        os.makedirs(os.path.join(static_root, 'img'))
+        for name, size in [('mrwf_master_logo_black.png', (400, 100)),
+                           ('checkbox.png', (20, 20))]:
+            Image.new('L', size, 255).save(
+                os.path.join(static_root, 'img', name), 'PNG')
+        self.static_settings = override_settings(STATIC_ROOT=static_root)
+        self.static_settings.enable()
+        pdfexport._assets.clear()
+        self.orgs = []
+        for i in range(5):
+            org = Organisation.objects.create(name='Org {0}'.format(i))
+            Contact.objects.create(obj=org, line_1='{0} Mill Road'.format(i),
+                                   town='Cambridge')
+            self.orgs.append(org)
+
+    def tearDown(self):
+        pdfexport._assets.clear()
+        self.static_settings.disable()
+        super(PdfExportTest, self).tearDown()
+
+    def write_pdf(self):
+        out = StringIO()
+        pdfexport.write_orgs_pdf(out, self.orgs)
+        return out.getvalue()
+
+    def get_forms(self):
+        dir_path = pdfexport.get_form_dir()
+        return dict((it, os.path.getmtime(os.path.join(dir_path, it)))
+                    for it in os.listdir(dir_path) if it.endswith('.pdf'))
+
+    def test_parallel_forms(self):
+        if pdfexport.PdfFileWriter is None:
+            return
+        from PyPDF2 import PdfFileReader
+        orgs_per_chunk = pdfexport.ORGS_PER_CHUNK
+        pdfexport.ORGS_PER_CHUNK = 2
+        try:
+            with self.settings(PDF_PROCESSES=2):
+                data = self.write_pdf()
+        finally:
+            pdfexport.ORGS_PER_CHUNK = orgs_per_chunk
+        self.assertTrue(PdfFileReader(StringIO(data)).numPages >= 5)
+        forms = self.get_forms()
+        self.assertEqual(len(forms), 5)
+
+        # the cached forms are used the next time
+        data = self.write_pdf()
+        self.assertTrue(PdfFileReader(StringIO(data)).numPages >= 5)
+        self.assertEqual(self.get_forms(), forms)
+
+
+class IntervalsTest(TestCase):
+    def setUp(self):
+        self.fair = Fair.objects.create(date=datetime.date(2013, 12, 7),
+                                        current=True)
+        owner = Person.objects.create(first_name='Ford', last_name='Prefect')
+        bounds = [(None, None), (10, None), (None, 14), (9, 17), (12, 12)]
+        for i, (start, end) in enumerate(bounds):
+            ages = bounds[(i + 1) % len(bounds)]
+            FairEvent.objects.create(
+                name='Event {0}'.format(i), owner=owner, fair=self.fair,
+                time=datetime.time(start) if start is not None else None,
+                end_time=datetime.time(end) if end is not None else None,
+                age_min=ages[0], age_max=ages[1])
+
+    def test_running_at(self):
+        index = intervals.FairIndex(self.fair)
+        events = FairEvent.objects.filter(fair=self.fair)
+        for hour in range(24):
+            time = datetime.time(hour)
+            expected = events.filter(
+                (Q(event__time__isnull=True) | Q(event__time__lte=time))
+                & (Q(event__end_time__isnull=True)
+                   | Q(event__end_time__gte=time)))
+            self.assertEqual(index.running_at(time),
+                             set(expected.values_list('pk', flat=True)))
+
+    def test_suitable_for(self):
+        index = intervals.FairIndex(self.fair)
+        events = FairEvent.objects.filter(fair=self.fair)
+        for age in range(1, 21):
+            expected = events.filter(
+                (Q(age_min__isnull=True) | Q(age_min__lte=age))
+                & (Q(age_max__isnull=True) | Q(age_max__gte=age)))
+            self.assertEqual(index.suitable_for(age),
+                             set(expected.values_list('pk', flat=True)))
+
+    def test_max_results(self):
+        index = intervals.IntervalIndex([(1, None, 5), (2, 3, None)])
+        for value in range(intervals.MAX_RESULTS * 2):
+            index.containing(value)
+        self.assertEqual(len(index._results), intervals.MAX_RESULTS)
+        self.assertEqual(index.containing(1000), frozenset([2]))
+
 __test__ = {"doctest": """
 Another way to test that 1 + 1 is equal to 2.
 
 >>> 1 + 1 == 2
 True
 """}
-
@@ -16,28 +16,163 @@
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import datetime
-from django.http import HttpResponse, Http404
+import os
+import csv
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.contrib.auth.decorators import login_required
+from django.core.servers.basehttp import FileWrapper
+from django.core.urlresolvers import reverse
 from django.template import Context
 from django.template.loader import get_template
-from django.shortcuts import get_object_or_404
-from cams.libcams import CSVFileResponse, get_time_string, make_group_file_name
-from cams.models import Record, Contact, Contactable, Member, Group, Fair
+from django.shortcuts import get_object_or_404, render_to_response
+from cams.libcams import get_time_string, make_group_file_name
+from cams.models import Group, Fair
 from cams.contacts import iterate_group_contacts
 from mrwf.extra.models import (FairEventType, FairEvent,
-                               StallEvent, StallInvoice)
+                               StallEvent, StallInvoice, ExportJob)
+from mrwf.extra.views.main import add_common_tpl_vars
 from mrwf.extra.views.mgmt import get_listing_id, get_stall_invoice_address
+from mrwf.extra import jobs
 
-@login_required
-def group(request, group_id):
-    group = get_object_or_404(Group, pk = group_id)
-    csv = CSVFileResponse(('first_name', 'middle_name', 'last_name',
-                           'contact_type', 'organisation',
-                           'line_1', 'line_2', 'line_3', 'town', 'postcode',
-                           'telephone', 'mobile', 'fax', 'email', 'website',
-                           'order', 'sub-order', 'role'))
+GROUP_COLUMNS = ('first_name', 'middle_name', 'last_name',
+                 'contact_type', 'organisation',
+                 'line_1', 'line_2', 'line_3', 'town', 'postcode',
+                 'telephone', 'mobile', 'fax', 'email', 'website',
+                 'order', 'sub-order', 'role')
+
+INVOICE_COLUMNS = ('stall_name', 'reference', 'owner', 'email',
+                   'organisation', 'email', 'invoice address',
+                   'tables', 'spaces', 'amount', 'status', 'created',
+                   'sent', 'paid', 'cancelled')
+
+PROGRAMME_COLUMNS = ('name', 'status', 'description', 'time',
+                     'until', 'age min', 'age max', 'location',
+                     'order', 'suborder',
+
+                     'event address', 'event telephone',
+                     'event mobile', 'event email', 'event website',
+
+                     'owner', 'owner address', 'owner telephone',
+                     'owner mobile', 'owner email', 'owner website',
+
+                     'organisation', 'org address', 'org telephone',
+                     'org mobile', 'org email', 'org website',
+                     'org order', 'org sub-order',
+
+                     'n. spaces', 'n. tables', 'stall', 'plot')
+
+PROGRAMME_CHUNK_SIZE = 200
+CSV_CHUNK_ROWS = 100
+
+
+def istr(value):
+    if value:
+        return str(value)
+    else:
+        return ''
+
+def utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def iterate_event_chunks(events, size):
+    # Only the ids are loaded up-front, to keep the order of the events
+    ids = list(events.values_list('pk', flat = True))
+    for i in range(0, len(ids), size):
+        chunk_ids = ids[i:(i + size)]
+        chunk = FairEvent.objects.filter(pk__in = chunk_ids)
+        chunk = dict((e.pk, e) for e in chunk.select_related('owner', 'org'))
+        yield [chunk[pk] for pk in chunk_ids if pk in chunk], len(ids)
+
+def make_programme_row(e, stall, c, owner_c, org_c):
+    if stall:
+        n_spaces = str(stall.n_spaces)
+        n_tables = str(stall.n_tables)
+        mc_stall = stall.mc_stall_option_str
+        plot_type = stall.plot_type_str
+    else:
+        n_spaces = ''
+        n_tables = ''
+        mc_stall = ''
+        plot_type = ''
+
+    if owner_c:
+        owner_addr = owner_c.get_address()
+        owner_tel = owner_c.telephone
+        owner_mob = owner_c.mobile
+        owner_email = owner_c.email
+        owner_website = owner_c.website
+    # ToDo: use 'empty' contact object
+    else:
+        owner_addr = ''
+        owner_tel = ''
+        owner_mob = ''
+        owner_email = ''
+        owner_website = ''
+
+    if e.org:
+        org_name = e.org.name
+    else:
+        org_name = ''
+
+    if org_c:
+        org_addr = org_c.get_address()
+        org_tel = org_c.telephone
+        org_mobile = org_c.mobile
+        org_email = org_c.email
+        org_website = org_c.website
+        org_order = istr(org_c.addr_order)
+        org_suborder = istr(org_c.addr_suborder)
+    else:
+        org_addr = ''
+        org_tel = ''
+        org_mobile = ''
+        org_email = ''
+        org_website = ''
+        org_order = ''
+        org_suborder = ''
+
+    return (e.name, e.status_str, e.description,
+            istr(e.time), istr(e.end_time),
+            istr(e.age_min), istr(e.age_max), e.location,
+            istr(c.addr_order), istr(c.addr_suborder),
+
+            c.get_address(), c.telephone,
+            c.mobile, c.email, c.website,
+
+            u'{0} {1}'.format(e.owner.first_name, e.owner.last_name),
+            owner_addr, owner_tel, owner_mob, owner_email,
+            owner_website,
+
+            org_name, org_addr, org_tel, org_mobile,
+            org_email, org_website, org_order, org_suborder,
+
+            n_spaces, n_tables, mc_stall, plot_type)
+
+def iterate_csv(columns, rows):
+    buf = StringIO()
+    writer = csv.writer(buf)
+
+    def flush():
+        data = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        return data
+
+    writer.writerow(columns)
+    for i, row in enumerate(rows, 1):
+        writer.writerow([utf8(it) for it in row])
+        if (i % CSV_CHUNK_ROWS) == 0:
+            yield flush()
 
+    yield flush()
+
+def iterate_group_rows(group):
     for it, role in iterate_group_contacts(group):
         if it.p:
             p_first_name = it.p.first_name
@@ -48,190 +183,80 @@ def group(request, group_id):
             p_middle_name = ''
             p_last_name = ''
 
-        csv.write((p_first_name, p_middle_name, p_last_name,
-                   it.ctype, it.org_name,
-                   it.c.line_1, it.c.line_2, it.c.line_3, it.c.town,
-                   it.c.postcode, it.c.telephone, it.c.mobile, it.c.fax,
-                   it.c.email, it.c.website,
-                   str(it.c.addr_order), str(it.c.addr_suborder),
-                   role.role))
-
-    csv.set_file_name(make_group_file_name(group) + '.csv')
-    return csv.response
+        yield (p_first_name, p_middle_name, p_last_name,
+               it.ctype, it.org_name,
+               it.c.line_1, it.c.line_2, it.c.line_3, it.c.town,
+               it.c.postcode, it.c.telephone, it.c.mobile, it.c.fax,
+               it.c.email, it.c.website,
+               str(it.c.addr_order), str(it.c.addr_suborder),
+               role.role)
 
-@login_required
-def group_email(request, group_id):
-    group = get_object_or_404(Group, pk = group_id)
+def iterate_group_email(group):
     emails = []
     for it, role in iterate_group_contacts(group):
         if it.c.email and it.c.email not in emails:
             emails.append(it.c.email)
     emails.sort()
-    resp = HttpResponse(mimetype = 'text/plain')
-    resp['Content-Disposition'] = 'attachement; filename=\"{0}\"'.format \
-        (make_group_file_name(group, '-email') + '.txt')
     n_emails = len(emails)
     range_step = 50
     for i, range_start in enumerate(range(0, n_emails, range_step)):
         range_stop = range_start + range_step
-        resp.write('Chunk {:d}\n'.format(i))
+        yield 'Chunk {:d}\n'.format(i)
         chunk_str = ''
         for e in emails[range_start:range_stop]:
             chunk_str += ('<' + e + '>, ')
-        resp.write(chunk_str.rstrip(', ') + '\n\n')
-    return resp
+        yield utf8(chunk_str.rstrip(', ') + '\n\n')
 
-@login_required
-def programme(request):
-    def istr(value):
-        if value:
-            return str(value)
-        else:
-            return ''
+def iterate_programme_rows(events, progress = None):
+    # The events are loaded in chunks with their stall details and contacts
+    # in a few queries each.
+    n_done = 0
+    for chunk, n_events in iterate_event_chunks(events, PROGRAMME_CHUNK_SIZE):
+        stalls = StallEvent.objects.in_bulk(
+            [e.pk for e in chunk if e.subtype == FairEvent.STALL])
+        contacts = FairEvent.get_composite_contacts(chunk)
+        owner_contacts = FairEvent.get_org_contacts(
+            set(e.owner_id for e in chunk))
+        org_contacts = FairEvent.get_org_contacts(
+            set(e.org_id for e in chunk if e.org_id))
 
-    events = FairEvent.objects.filter(fair__current = True)
+        for e in chunk:
+            yield make_programme_row(e, stalls.get(e.pk), contacts[e.pk],
+                                     owner_contacts.get(e.owner_id),
+                                     org_contacts.get(e.org_id))
 
-    listing = get_listing_id(request)
-    if listing > 0:
-        events = events.filter(etype = listing)
-        listing_obj = get_object_or_404(FairEventType, pk = listing)
-        file_name = u'Programme_{0}'.format(listing_obj.name.replace(' ', '_'))
-    elif listing == 0:
-        events = events.filter(etype__isnull = True)
-        file_name = u'Programme_Default'
-    else:
-        file_name = u'Programme'
+        n_done += len(chunk)
+        if progress:
+            progress(n_done, n_events)
 
-    if 'fmt' in request.GET:
-        fmt = request.GET['fmt']
-    else:
-        fmt='csv'
+def iterate_programme_csv(events, progress = None):
+    return iterate_csv(PROGRAMME_COLUMNS,
+                       iterate_programme_rows(events, progress))
 
-    if fmt == 'csv':
-        csv = CSVFileResponse(('name', 'status', 'description', 'time',
-                               'until', 'age min', 'age max', 'location',
-                               'order', 'suborder',
-
-                               'event address', 'event telephone',
-                               'event mobile', 'event email', 'event website',
-
-                               'owner', 'owner address', 'owner telephone',
-                               'owner mobile', 'owner email', 'owner website',
-
-                               'organisation', 'org address', 'org telephone',
-                               'org mobile', 'org email', 'org website',
-                               'org order', 'org sub-order',
-
-                               'n. spaces', 'n. tables', 'stall', 'plot'))
-
-        csv.set_file_name(u'{0}_{1}.csv'.format(file_name, get_time_string()))
-
-        for e in events:
-            # ToDo: add subtype field in base FairEvent like Contactable ?
-            try:
-                stall = StallEvent.objects.get(pk = e.id)
-                n_spaces = str(stall.n_spaces)
-                n_tables = str(stall.n_tables)
-                mc_stall = stall.mc_stall_option_str
-                plot_type = stall.plot_type_str
-            except StallEvent.DoesNotExist:
-                n_spaces = ''
-                n_tables = ''
-                mc_stall = ''
-                plot_type = ''
-
-            c = e.get_composite_contact()
-
-            if e.owner.contact_set.count() > 0:
-                owner_c = e.owner.contact_set.all()[0]
-                owner_addr = owner_c.get_address()
-                owner_tel = owner_c.telephone
-                owner_mob = owner_c.mobile
-                owner_email = owner_c.email
-                owner_website = owner_c.website
-            # ToDo: use 'empty' contact object
-            else:
-                owner_addr = ''
-                owner_tel = ''
-                owner_mob = ''
-                owner_email = ''
-                owner_website = ''
-
-            if e.org:
-                org_name = e.org.name
-                if e.org.contact_set.count() > 0:
-                    org_c = e.org.contact_set.all()[0]
-                else:
-                    org_c = None
-            else:
-                org_name = ''
-                org_c = None
-
-            if org_c:
-                org_addr = org_c.get_address()
-                org_tel = org_c.telephone
-                org_mobile = org_c.mobile
-                org_email = org_c.email
-                org_website = org_c.website
-                org_order = istr(org_c.addr_order)
-                org_suborder = istr(org_c.addr_suborder)
-            else:
-                org_addr = ''
-                org_tel = ''
-                org_mobile = ''
-                org_email = ''
-                org_website = ''
-                org_order = ''
-                org_suborder = ''
-
-            csv.write((e.name, e.status_str, e.description,
-                       istr(e.time), istr(e.end_time),
-                       istr(e.age_min), istr(e.age_max), e.location,
-                       istr(c.addr_order), istr(c.addr_suborder),
-
-                       c.get_address(), c.telephone,
-                       c.mobile, c.email, c.website,
-
-                       u'{0} {1}'.format(e.owner.first_name,e.owner.last_name),
-                       owner_addr, owner_tel, owner_mob, owner_email,
-                       owner_website,
-
-                       org_name, org_addr, org_tel, org_mobile,
-                       org_email, org_website, org_order, org_suborder,
-
-                       n_spaces, n_tables, mc_stall, plot_type))
-
-        return csv.response
-    elif fmt == 'plaintext':
-        resp = HttpResponse(mimetype = 'text/plain')
-        resp['Content-Disposition'] = \
-            u'attachement; filename=\"{0}_{1}.txt\"'.format \
-            (file_name, get_time_string())
-        t = get_template("cams/prog_event.txt")
-        ctx = Context({'e': None, 'c': None})
-
-        for e in events:
+def iterate_programme_txt(events, progress = None):
+    t = get_template("cams/prog_event.txt")
+    ctx = Context({'e': None, 'c': None})
+    n_done = 0
+
+    for chunk, n_events in iterate_event_chunks(events, PROGRAMME_CHUNK_SIZE):
+        contacts = FairEvent.get_composite_contacts(chunk)
+
+        for e in chunk:
             ctx['e'] = e
-            ctx['c'] = e.get_composite_contact()
-            resp.write(t.render(ctx))
+            ctx['c'] = contacts[e.pk]
+            yield utf8(t.render(ctx))
 
-        return resp
-    else:
-        raise Http404
+        n_done += len(chunk)
+        if progress:
+            progress(n_done, n_events)
 
-@login_required
-def invoices(request):
+def iterate_invoice_rows(invs):
     def date_str(datetime):
         if datetime:
             return str(datetime.date())
         else:
             return ''
 
-    invs = StallInvoice.objects.filter(stall__event__fair=Fair.get_current())
-    resp = CSVFileResponse(('stall_name', 'reference', 'owner', 'email',
-                            'organisation', 'email', 'invoice address',
-                            'tables', 'spaces', 'amount', 'status', 'created',
-                            'sent', 'paid', 'cancelled'))
     for i in invs:
         if i.stall.org:
             org_name = i.stall.org.__unicode__()
@@ -251,10 +276,118 @@ def invoices(request):
             email = c.email
         else:
             email = ''
-        resp.write((i.stall.name, i.reference, i.stall.owner.__unicode__(),
-                    email, org_name, address, str(i.stall.n_tables),
-                    str(i.stall.n_spaces), str(i.amount), i.status_str,
-                    date_str(i.created), date_str(i.sent), date_str(i.paid),
-                    date_str(i.cancelled)))
-    resp.set_file_name(u'Stall_invoices_{0}.csv'.format(get_time_string()))
-    return resp.response
+        yield (i.stall.name, i.reference, i.stall.owner.__unicode__(),
+               email, org_name, address, str(i.stall.n_tables),
+               str(i.stall.n_spaces), str(i.amount), i.status_str,
+               date_str(i.created), date_str(i.sent), date_str(i.paid),
+               date_str(i.cancelled))
+
+def get_programme_events(listing):
+    events = FairEvent.objects.filter(fair__current = True)
+    if listing > 0:
+        events = events.filter(etype = listing)
+    elif listing == 0:
+        events = events.filter(etype__isnull = True)
+    return events
+
+# -----------------------------------------------------------------------------
+# export jobs, run by the workers
+
+def export_group(out, progress, group_id):
+    group = Group.objects.get(pk = group_id)
+    jobs.write_chunks(out, iterate_csv(GROUP_COLUMNS,
+                                       iterate_group_rows(group)))
+
+def export_group_email(out, progress, group_id):
+    group = Group.objects.get(pk = group_id)
+    jobs.write_chunks(out, iterate_group_email(group))
+
+def export_programme(out, progress, listing, fmt):
+    events = get_programme_events(listing)
+    if fmt == 'csv':
+        jobs.write_chunks(out, iterate_programme_csv(events, progress))
+    else:
+        jobs.write_chunks(out, iterate_programme_txt(events, progress))
+
+def export_invoices(out, progress):
+    invs = StallInvoice.objects.filter(stall__event__fair=Fair.get_current())
+    jobs.write_chunks(out, iterate_csv(INVOICE_COLUMNS,
+                                       iterate_invoice_rows(invs)))
+
+jobs.register('group', export_group)
+jobs.register('group_email', export_group_email)
+jobs.register('programme', export_programme)
+jobs.register('invoices', export_invoices)
+
+def start_job(request, name, params, file_name, mimetype):
+    job = jobs.submit(name, params, file_name, mimetype, request.user)
+    return HttpResponseRedirect(reverse('export_job', args=[job.pk]))
+
+# -----------------------------------------------------------------------------
+# views
+
+@login_required
+def group(request, group_id):
+    group = get_object_or_404(Group, pk = group_id)
+    return start_job(request, 'group', {'group_id': group.pk},
+                     make_group_file_name(group) + '.csv', 'text/csv')
+
+@login_required
+def group_email(request, group_id):
+    group = get_object_or_404(Group, pk = group_id)
+    return start_job(request, 'group_email', {'group_id': group.pk},
+                     make_group_file_name(group, '-email') + '.txt',
+                     'text/plain')
+
+@login_required
+def programme(request):
+    listing = get_listing_id(request)
+    if listing > 0:
+        listing_obj = get_object_or_404(FairEventType, pk = listing)
+        file_name = u'Programme_{0}'.format(listing_obj.name.replace(' ', '_'))
+    elif listing == 0:
+        file_name = u'Programme_Default'
+    else:
+        file_name = u'Programme'
+
+    if 'fmt' in request.GET:
+        fmt = request.GET['fmt']
+    else:
+        fmt='csv'
+
+    if fmt == 'csv':
+        ext, mimetype = 'csv', 'text/csv'
+    elif fmt == 'plaintext':
+        ext, mimetype = 'txt', 'text/plain'
+    else:
+        raise Http404
+
+    return start_job(request, 'programme', {'listing': listing, 'fmt': fmt},
+                     u'{0}_{1}.{2}'.format(file_name, get_time_string(), ext),
+                     mimetype)
+
+@login_required
+def invoices(request):
+    return start_job(request, 'invoices', {},
+                     u'Stall_invoices_{0}.csv'.format(get_time_string()),
+                     'text/csv')
+
+@login_required
+def job(request, job_id):
+    job = get_object_or_404(ExportJob, pk = job_id)
+    tpl_vars = {'title': 'Export', 'job': job}
+    add_common_tpl_vars(request, tpl_vars, 'home')
+    return render_to_response('cams/export_job.html', tpl_vars)
+
+@login_required
+def job_file(request, job_id):
+    job = get_object_or_404(ExportJob, pk = job_id, status = ExportJob.DONE)
+    try:
+        f = open(jobs.get_path(job), 'rb')
+    except IOError:
+        raise Http404
+    resp = HttpResponse(FileWrapper(f), mimetype = job.mimetype)
+    resp['Content-Length'] = str(os.fstat(f.fileno()).st_size)
+    resp['Content-Disposition'] = u'attachement; filename=\"{0}\"'.format \
+        (job.file_name)
+    return resp
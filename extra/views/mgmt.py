@@ -292,7 +292,7 @@ def prog_event (request, event_id):
         raise Http404
     form = get_form_if_actor (request, event_id)
 
-    if StallEvent.objects.filter (pk = event_id).exists ():
+    if ev.subtype == FairEvent.STALL:
         admin_type = 'stallevent'
     else:
         admin_type = 'fairevent'
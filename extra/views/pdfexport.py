@@ -18,47 +18,84 @@
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
+import os
+import hashlib
 from copy import deepcopy
+from multiprocessing import Pool, cpu_count
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import inch
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.lib.enums import TA_CENTER, TA_LEFT
 from reportlab.platypus import (SimpleDocTemplate, Image, Paragraph, Spacer,
                                 PageBreak)
-from django.http import HttpResponse
+from django.db import connection
 from django.shortcuts import get_object_or_404
 from django.contrib.auth.decorators import login_required
-from cams.models import Contactable, Person, Organisation, Group
+from cams.models import (Contactable, Person, Organisation, Group, Contact,
+                         Member)
 from cams.libcams import make_group_file_name
 from cams.pdftools import append_org_form
 from django.conf import settings
+from mrwf.extra import jobs, imaging
+from mrwf.extra.views.export import start_job
+try:
+    from PyPDF2 import PdfFileReader, PdfFileWriter
+    from PyPDF2.generic import (IndirectObject, DictionaryObject,
+                                ArrayObject, NameObject)
+except ImportError:
+    PdfFileWriter = None
 
-@login_required
-def group_org_pdf(request, group_id):
-    group = get_object_or_404(Group, pk=group_id)
-    orgs = group.members.filter(type=Contactable.ORGANISATION)
+# Number of organisation forms rendered by each process
+ORGS_PER_CHUNK = 50
+
+# To be changed with the layout of the forms to render them again
+FORM_VERSION = 2
+
+# Resolution of the images in the PDFs
+ASSET_DPI = 200
+
+_assets = {}
+_flowables = {}
+
+def get_asset(name, width, height):
+    """Get the path to a static image scaled for its size in the PDFs.
+
+    The scaled copies are kept with the other cached files and only made
+    again if the original is changed.
+    """
+    size = (int(width * ASSET_DPI / 72), int(height * ASSET_DPI / 72))
+    key = (name, size)
+    path = _assets.get(key)
+    if path is None:
+        src_path = os.path.join(settings.STATIC_ROOT, 'img', name)
+        dir_path = os.path.join(settings.CACHE_PATH, 'pdf', 'img')
+        base, ext = os.path.splitext(name)
+        path = os.path.join(dir_path, '{0}-{1}x{2}{3}'.format(
+                base, size[0], size[1], ext))
+        if not os.path.exists(path) \
+                or os.path.getmtime(path) < os.path.getmtime(src_path):
+            if not os.path.isdir(dir_path):
+                os.makedirs(dir_path)
+            imaging.scale_file(src_path, path, size)
+        _assets[key] = path
+    return path
 
-    response = HttpResponse(mimetype='application/pdf')
-    response['Content-Disposition'] = 'attachement; filename=\"%s\"' % \
-        (make_group_file_name(group, '-org-forms') + '.pdf')
+def get_form_flowables(page_size):
+    # The flowables are the same for all the forms, so they are only made
+    # once per process and the images are kept decoded (lazy=0).  ReportLab
+    # then embeds each image once per document and reuses it on every page.
+    flowables = _flowables.get(page_size)
+    if flowables is not None:
+        return flowables
 
-    buf = StringIO()
     styles = getSampleStyleSheet()
-    page_size = A4
-    doc = SimpleDocTemplate(buf, pagesize=page_size)
-    flow = []
 
     image_w = 1056
     image_h = 270
     w = page_size[0] * 0.4
     h = w * image_h / image_w
-    letterhead = Image(settings.STATIC_ROOT
-                       + '/img/mrwf_master_logo_black.png',
-                       width=w, height=h)
+    letterhead = Image(get_asset('mrwf_master_logo_black.png', w, h),
+                       width=w, height=h, lazy=0)
 
     head_style = deepcopy(styles["Normal"])
     head_style.fontSize = 10
@@ -75,30 +112,231 @@ at the bottom to show that it is correct.  Then, drop it in at the Post Office
 at Al-Amin's.""", instr_style)
 
     img = '<img src="%s" width="%d" height="%d" />' % \
-        (settings.STATIC_ROOT + '/img/checkbox.png', 10, 10)
+        (get_asset('checkbox.png', 10, 10), 10, 10)
     check = Paragraph(img +
-                      '  Please check this box if all details are correct.',
+                      '  Please check this box if all details are correct.',
                       instr_style)
 
     spacer = Spacer(0, inch/2)
+    flowables = (letterhead, head_txt, head_email, instr, check, spacer)
+    _flowables[page_size] = flowables
+    return flowables
+
+def get_orgs(org_ids):
+    orgs = Organisation.objects.in_bulk(org_ids)
+    return [orgs[pk] for pk in org_ids if pk in orgs]
+
+def write_org_forms(out, orgs, on_page=None):
+    page_size = A4
+    doc = SimpleDocTemplate(out, pagesize=page_size)
+    letterhead, head_txt, head_email, instr, check, spacer = \
+        get_form_flowables(page_size)
     page_break = PageBreak()
+    flow = []
 
-    for o in orgs:
+    for org in orgs:
         flow.append(letterhead)
         flow.append(head_txt)
         flow.append(head_email)
         flow.append(spacer)
         flow.append(instr)
         flow.append(spacer)
-        org = Organisation.objects.get(pk=o)
         append_org_form(org, flow, page_size)
         flow.append(spacer)
         flow.append(check)
         flow.append(page_break)
 
-    doc.build(flow)
-    pdf = buf.getvalue()
-    buf.close()
-    response.write(pdf)
+    if on_page is None:
+        doc.build(flow)
+    else:
+        doc.build(flow, onFirstPage=on_page, onLaterPages=on_page)
+
+def get_row(obj):
+    return [(f.attname, getattr(obj, f.attname)) for f in obj._meta.fields]
+
+def get_form_keys(orgs):
+    """Get a hash of the data shown in the form of each organisation."""
+    org_ids = [org.pk for org in orgs]
+    data = dict((org.pk, [FORM_VERSION, get_row(org)]) for org in orgs)
+
+    for c in Contact.objects.filter(obj__in=org_ids).order_by('pk'):
+        data[c.obj_id].append(get_row(c))
+
+    members = list(Member.objects.filter(organisation__in=org_ids)
+                   .order_by('pk'))
+    people = Person.objects.in_bulk(set(m.person_id for m in members))
+    member_orgs = dict((m.pk, m.organisation_id) for m in members)
+
+    for m in members:
+        rows = data[m.organisation_id]
+        rows.append(get_row(m))
+        if m.person_id in people:
+            rows.append(get_row(people[m.person_id]))
+
+    # the contact details of the members are Contact objects linked to them
+    member_contacts = Contact.objects.filter(obj__in=member_orgs.keys())
+    for c in member_contacts.order_by('pk'):
+        data[member_orgs[c.obj_id]].append(get_row(c))
 
-    return response
+    return dict((pk, hashlib.sha1(repr(rows)).hexdigest())
+                for pk, rows in data.iteritems())
+
+def get_form_dir():
+    return os.path.join(settings.CACHE_PATH, 'pdf', 'org')
+
+def render_org_form(org, path):
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as out:
+        write_org_forms(out, [org])
+    os.rename(tmp_path, path)
+
+    # remove the forms rendered with older data
+    dir_path, file_name = os.path.split(path)
+    prefix = '{0}-'.format(org.pk)
+    for it in os.listdir(dir_path):
+        if it.startswith(prefix) and it.endswith('.pdf') and it != file_name:
+            try:
+                os.remove(os.path.join(dir_path, it))
+            except OSError:
+                pass
+
+def render_org_forms(org_paths):
+    # run in the pool processes
+    orgs = Organisation.objects.in_bulk([it[0] for it in org_paths])
+    for org_id, path in org_paths:
+        render_org_form(orgs[org_id], path)
+    return len(org_paths)
+
+def get_n_processes():
+    n = settings.PDF_PROCESSES
+    if n is None:
+        n = cpu_count()
+    return n
+
+def get_object_key(obj):
+    # hash of the contents of a PDF object, following the references
+    if isinstance(obj, IndirectObject):
+        obj = obj.getObject()
+    if isinstance(obj, DictionaryObject):
+        items = sorted((k, get_object_key(v)) for k, v in obj.iteritems()
+                       if k != '/Length')
+        data = getattr(obj, '_data', None) or ''
+        return hashlib.sha1(repr(items) + data).hexdigest()
+    if isinstance(obj, ArrayObject):
+        return repr([get_object_key(v) for v in obj])
+    return repr(obj)
+
+def share_images(page, images):
+    # replace the images of the page with the identical ones already seen
+    resources = page.get('/Resources')
+    if resources is None:
+        return
+    xobjects = resources.getObject().get('/XObject')
+    if xobjects is None:
+        return
+    xobjects = xobjects.getObject()
+    for name, ref in xobjects.items():
+        if not isinstance(ref, IndirectObject):
+            continue
+        if ref.getObject().get('/Subtype') != '/Image':
+            continue
+        key = get_object_key(ref)
+        if key in images:
+            xobjects[NameObject(name)] = images[key]
+        else:
+            images[key] = ref
+
+def merge_forms(out, paths):
+    """Merge the PDF files of the organisation forms.
+
+    Each file has its own copy of the images, so only the first copy of each
+    image is kept and used by all the pages.  PdfFileWriter keeps all the
+    pages in memory and the files open until the output is written.
+    """
+    writer = PdfFileWriter()
+    images = {}
+    files = []
+    try:
+        for path in paths:
+            f = open(path, 'rb')
+            files.append(f)
+            for page in PdfFileReader(f).pages:
+                share_images(page, images)
+                writer.addPage(page)
+        writer.write(out)
+    finally:
+        for f in files:
+            f.close()
+
+def write_group_org_pdf(out, group, progress=None):
+    orgs = group.members.filter(type=Contactable.ORGANISATION)
+    write_orgs_pdf(out, get_orgs(list(orgs.values_list('pk', flat=True))),
+                   progress)
+
+def write_orgs_pdf(out, orgs, progress=None):
+    if PdfFileWriter is None:
+        # each organisation form is normally on one page
+        def on_page(canvas, doc):
+            if progress:
+                progress(min(doc.page, len(orgs)), len(orgs))
+
+        write_org_forms(out, orgs, on_page)
+        return
+
+    # The form of each organisation is kept in its own file, named after the
+    # hash of its data.  Only the missing ones are rendered, in chunks with a
+    # pool of processes if there are many of them, and then all the forms
+    # are merged into the output file.
+    dir_path = get_form_dir()
+    if not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+    keys = get_form_keys(orgs)
+    paths = []
+    missing = []
+    for org in orgs:
+        file_name = '{0}-{1}.pdf'.format(org.pk, keys[org.pk])
+        path = os.path.join(dir_path, file_name)
+        paths.append(path)
+        if not os.path.exists(path):
+            missing.append((org, path))
+
+    n_processes = get_n_processes()
+    n_steps = len(missing) + 1
+
+    if n_processes < 2 or len(missing) <= ORGS_PER_CHUNK:
+        for i, (org, path) in enumerate(missing):
+            render_org_form(org, path)
+            if progress:
+                progress(i + 1, n_steps)
+    else:
+        chunks = []
+        for i in range(0, len(missing), ORGS_PER_CHUNK):
+            chunks.append([(org.pk, path) for org, path
+                           in missing[i:(i + ORGS_PER_CHUNK)]])
+
+        # the processes open their own database connections
+        connection.close()
+        pool = Pool(min(n_processes, len(chunks)))
+        try:
+            n_done = 0
+            for n in pool.imap_unordered(render_org_forms, chunks):
+                n_done += n
+                if progress:
+                    progress(n_done, n_steps)
+            pool.close()
+        finally:
+            pool.terminate()
+
+    merge_forms(out, paths)
+
+def export_group_org_pdf(out, progress, group_id):
+    write_group_org_pdf(out, Group.objects.get(pk=group_id), progress)
+
+jobs.register('group_org_pdf', export_group_org_pdf)
+
+@login_required
+def group_org_pdf(request, group_id):
+    group = get_object_or_404(Group, pk=group_id)
+    return start_job(request, 'group_org_pdf', {'group_id': group.pk},
+                     make_group_file_name(group, '-org-forms') + '.pdf',
+                     'application/pdf')
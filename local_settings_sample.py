@@ -29,6 +29,7 @@ settings.DATABASES = {
 }
 
 settings.LOG_PATH = 'log'
+settings.CACHE_PATH = 'cache'
 settings.MEDIA_ROOT = os.path.join(BASE_DIR, 'upload')
 settings.MEDIA_URL = '/static/mrwf/upload/'
 settings.ADMIN_MEDIA_PREFIX = '/media/'
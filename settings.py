@@ -105,6 +105,17 @@ SESSION_EXPIRE_AT_BROWSER_CLOSE = True
 IMG_MAX_D = 800
 IMG_MAX_d = 600
 
+# Largest dimension of the scaled copies of the event images, and their
+# formats (the ones not supported by the imaging library are skipped)
+IMG_SIZES = (120, 320, 800)
+IMG_FORMATS = ('WEBP', 'JPEG')
+
+# Directory where generated files are kept (public programme snapshots...)
+CACHE_PATH = 'cache'
+
+# Number of processes used to render large PDF exports, None for one per CPU
+PDF_PROCESSES = None
+
 # site-dependent settings
 import local_settings
 import os